@@ -0,0 +1,36 @@
+"""A tiny BLAP2 stand-in for benchmarking music-caption without the real checkpoint.
+
+Start music-caption with CAPTION_MODEL_FACTORY=benchmarks.blap_standin:load (repo root on
+PYTHONPATH). The model pools the audio into frames and runs a small MLP over them, so
+cost grows with clip length and batch size like the real encoder, then returns canned
+captions. STANDIN_DECODE_MS_PER_BEAM adds a per-clip delay standing in for beam search.
+"""
+import os
+import time
+import torch
+
+STANDIN_DECODE_MS_PER_BEAM = float(os.getenv("STANDIN_DECODE_MS_PER_BEAM", "2"))
+FRAME = 1024
+HIDDEN = 256
+
+class StandInCaptioner(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.audio_encoder = torch.nn.Sequential(
+            torch.nn.Linear(FRAME, HIDDEN),
+            torch.nn.GELU(),
+            torch.nn.Linear(HIDDEN, HIDDEN),
+        )
+
+    def predict_answers(self, samples: torch.Tensor, prompt: str, max_len: int = 40, min_len: int = 30,
+                        num_beams: int = 10):
+        samples = samples.reshape(samples.shape[0], -1)
+        usable = samples.shape[-1] // FRAME * FRAME
+        frames = samples[:, :usable].reshape(samples.shape[0], -1, FRAME)
+        features = self.audio_encoder(frames).mean(dim=1)
+        time.sleep(STANDIN_DECODE_MS_PER_BEAM * num_beams * samples.shape[0] / 1000)
+        return [f"stand-in caption ({max_len} tokens, energy {float(feature.norm()):.3f})" for feature in features]
+
+def load(checkpoint_path: str, model_config_path: str) -> StandInCaptioner:
+    torch.manual_seed(0)
+    return StandInCaptioner()
@@ -0,0 +1,595 @@
+"""Offline end-to-end benchmarks for the services, against local stand-in backends.
+
+    python -m benchmarks.run                                  # every scenario
+    python -m benchmarks.run vqa repository-history -o new.json
+    python -m benchmarks.run --compare old.json new.json      # diff two result files
+    python -m benchmarks.run caption-profiles --caption-factory "" --caption-audio clips/*.wav
+                                                              # caption profiles on the real model
+
+Each scenario starts the services it needs (plus the stubs from benchmarks/stubs.py)
+as fresh uvicorn processes on free ports with temporary storage, drives them with
+concurrent httpx clients and records throughput, p50/p95/p99 latency and the peak RSS
+of every process. Results are written as JSON so runs can be compared.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from typing import Awaitable, Callable, Dict, List, Optional
+import httpx
+import numpy as np
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVICES_DIR = os.path.join(REPO_ROOT, "services")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """High-water mark of the process's resident set (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def process_tree_pss_mb(pid: int) -> Optional[float]:
+    """Proportional set size of a process and all its descendants: shared pages are split
+    between the processes sharing them instead of being counted once per process."""
+    total_kb = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/smaps_rollup") as f:
+                total_kb += sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except OSError:
+        return None
+    return total_kb / 1024
+
+class Service:
+    """A uvicorn process serving `app` from `cwd`, stopped when the scenario ends.
+
+    `command` replaces `-m uvicorn app` for services with their own launcher; --host and
+    --port are appended to it either way.
+    """
+    def __init__(self, name: str, cwd: str, app: str, env: Dict[str, str], ready_path: str = "/",
+                 startup_timeout: float = 120.0, command: Optional[List[str]] = None):
+        self.name = name
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.ready_path = ready_path
+        self.startup_timeout = startup_timeout
+        full_env = dict(os.environ)
+        full_env.update(env)
+        full_env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, full_env.get("PYTHONPATH")]))
+        self.log = tempfile.TemporaryFile()
+        command = command or ["-m", "uvicorn", app, "--log-level", "warning"]
+        self.process = subprocess.Popen(
+            [sys.executable, *command, "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=cwd, env=full_env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self):
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited during startup:\n{self.output()}")
+            try:
+                if httpx.get(self.url + self.ready_path, timeout=2.0).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{self.name} was not ready after {self.startup_timeout}s:\n{self.output()}")
+
+    def output(self) -> str:
+        self.log.seek(0)
+        return self.log.read().decode(errors="replace")[-4000:]
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+class Stack:
+    """The processes of one scenario; peak RSS is read while they are still alive."""
+    def __init__(self):
+        self.services: Dict[str, Service] = {}
+        self.work_dir = tempfile.mkdtemp(prefix="bench-")
+
+    def start(self, name: str, cwd: str, app: str, env: Dict[str, str] = None, ready_path: str = "/",
+              command: Optional[List[str]] = None) -> Service:
+        service = Service(name, cwd, app, env or {}, ready_path, command=command)
+        self.services[name] = service
+        service.wait_ready()
+        return service
+
+    def stub(self, name: str, stub: str, env: Dict[str, str] = None) -> Service:
+        factory = {"vlm": "create_vlm_app", "task-monitor": "create_task_monitor_app"}[stub]
+        return self.start(name, REPO_ROOT, f"benchmarks.stubs:{factory}", dict(env or {}), ready_path="/docs")
+
+    def pss(self) -> Dict[str, Optional[float]]:
+        return {name: process_tree_pss_mb(service.process.pid) for name, service in self.services.items()}
+
+    def peak_rss(self) -> Dict[str, Optional[float]]:
+        return {name: peak_rss_mb(service.process.pid) for name, service in self.services.items()}
+
+    def close(self):
+        for service in self.services.values():
+            service.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+async def run_load(request: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]], total: int,
+                   concurrency: int, timeout: float = 300.0) -> dict:
+    """Issue `total` requests with at most `concurrency` in flight and summarise their latency."""
+    latencies = []
+    errors = []
+    transferred = 0
+    next_index = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def worker():
+            nonlocal next_index, transferred
+            while next_index < total:
+                index = next_index
+                next_index += 1
+                started = time.perf_counter()
+                try:
+                    response = await request(client, index)
+                    if response.status_code >= 400:
+                        errors.append(f"HTTP {response.status_code}: {response.text[:200]}")
+                        continue
+                    transferred += len(response.content)
+                except Exception as e:
+                    errors.append(repr(e))
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(max(1, min(concurrency, total)))])
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:3],
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "response_mb_per_second": transferred / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+# Synthetic inputs
+
+def make_image(width: int = 1920, height: int = 1080) -> bytes:
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    return buf.getvalue()
+
+def make_track(seconds: float, sr: int = 48000, seed: int = 0) -> bytes:
+    """A WAV with a quiet bed and a few loud bursts, so highlight search has something to find."""
+    import soundfile as sf
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    y = 0.05 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(len(t))
+    for start in rng.uniform(0, max(1.0, seconds - 5), size=3):
+        burst = slice(int(start * sr), int((start + 5) * sr))
+        y[burst] += 0.5 * np.sin(2 * np.pi * 440 * t[burst])
+    buf = io.BytesIO()
+    sf.write(buf, y.astype(np.float32), sr, format="WAV")
+    return buf.getvalue()
+
+# Scenarios: each returns {result name: result}
+
+def repository_env(stack: Stack, **history_options) -> Dict[str, str]:
+    main_root = os.path.join(stack.work_dir, "storage")
+    history_root = os.path.join(stack.work_dir, "history")
+    os.makedirs(main_root)
+    os.makedirs(history_root)
+    return {
+        "STORAGE_CONFIG_JSON": json.dumps({"type": "file", "root": main_root}),
+        "HISTORY_STORAGE_CONFIG_JSON": json.dumps({"type": "file", "root": history_root, **history_options}),
+    }
+
+def scenario_vqa(stack: Stack, args) -> dict:
+    vlm = stack.stub("vlm-stub", "vlm")
+    monitor = stack.stub("task-monitor-stub", "task-monitor")
+    gateway = stack.start("task-manager", os.path.join(SERVICES_DIR, "task-manager"), "main:app", {
+        "OPENAI_MIDDLE_URL": vlm.url + "/v1",
+        "TASK_MONITOR_URL": monitor.url,
+        "JOB_STORE_DIR": os.path.join(stack.work_dir, "jobs"),
+    }, ready_path="/docs")
+    image = make_image()
+    results = {}
+    for stream in (False, True):
+        async def request(client, index, stream=stream):
+            return await client.post(gateway.url + "/vqa", data={"prompt": f"Describe image {index}", "stream": str(stream).lower()},
+                                     files=[("images", ("image.png", image, "image/png"))])
+        results["vqa-stream" if stream else "vqa"] = asyncio.run(run_load(request, args.requests, args.concurrency))
+    return results
+
+def scenario_repository_large_file(stack: Stack, args) -> dict:
+    repository = stack.start("repository", os.path.join(SERVICES_DIR, "repository"), "main:app", repository_env(stack))
+    size = args.large_file_mb * 1024 * 1024
+    payload = os.urandom(size)
+    form = {"description": "benchmark", "evaluation": "none", "additional_info": "{}"}
+
+    async def upload(client, index):
+        return await client.post(repository.url + "/files/upload", data={**form, "file_path": f"large/{index}.bin"},
+                                 files={"file": ("large.bin", payload)})
+
+    async def download(client, index):
+        return await client.get(repository.url + "/files/download", params={"file_path": f"large/{index % uploads}.bin"})
+
+    uploads = max(1, args.requests // 8)
+    return {
+        "repository-upload": asyncio.run(run_load(upload, uploads, min(args.concurrency, 4))),
+        "repository-download": asyncio.run(run_load(download, args.requests, args.concurrency)),
+    }
+
+def scenario_repository_history(stack: Stack, args) -> dict:
+    repository = stack.start("repository", os.path.join(SERVICES_DIR, "repository"), "main:app",
+                             repository_env(stack, content_addressed=True))
+    files, versions = 20, args.history_versions
+    form = {"description": "benchmark track", "evaluation": "none", "additional_info": "{}"}
+
+    async def upload(client, index):
+        # Every file gets `versions` uploads, every other one repeats the previous content
+        path, version = f"history/{index % files}.wav", index // files
+        return await client.post(repository.url + "/files/upload", data={**form, "file_path": path},
+                                 files={"file": ("track.wav", f"{path}:{version // 2}".encode() * 1024)})
+
+    async def mixed(client, index):
+        path = f"history/{index % files}.wav"
+        kind = index % 4
+        if kind == 0:
+            return await client.get(repository.url + "/files/history-count", params={"file_path": path})
+        if kind == 1:
+            return await client.get(repository.url + "/files/metadata",
+                                    params={"file_path": path, "version": 1 + index % (versions - 1)})
+        if kind == 2:
+            return await client.get(repository.url + "/files/download",
+                                    params={"file_path": path, "version": 1 + index % (versions - 1)})
+        return await client.get(repository.url + "/files/list",
+                                params={"root_path": "history", "limit": 100, "include_metadata": "true"})
+
+    return {
+        "repository-history-upload": asyncio.run(run_load(upload, files * versions, 1)),
+        "repository-history-read": asyncio.run(run_load(mixed, args.requests * 4, args.concurrency)),
+    }
+
+def scenario_highlight_batch(stack: Stack, args) -> dict:
+    analysis = stack.start("music-analysis", os.path.join(SERVICES_DIR, "music-analysis"), "main:app", {
+        # Measure the analysis itself, not the result cache
+        "RESULT_CACHE_MAX_BYTES": "0",
+    }, ready_path="/docs")
+    tracks = [make_track(args.track_seconds, seed=i) for i in range(args.batch_tracks)]
+
+    async def single(client, index):
+        return await client.post(analysis.url + "/music-highlight", params={"count": 3},
+                                 files={"audios": ("track.wav", tracks[index % len(tracks)], "audio/wav")})
+
+    async def batch(client, index):
+        response = await client.post(analysis.url + "/music-highlight/batch", data={"count": "3"},
+                                     files=[("audios", (f"{i}.wav", track, "audio/wav")) for i, track in enumerate(tracks)])
+        if response.status_code == 200:
+            with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+                json.loads(archive.read("manifest.json"))
+        return response
+
+    return {
+        "highlight": asyncio.run(run_load(single, args.requests, args.concurrency)),
+        "highlight-batch": asyncio.run(run_load(batch, max(1, args.requests // len(tracks)), 1)),
+    }
+
+def scenario_music_caption(stack: Stack, args) -> dict:
+    try:
+        import torch  # noqa: F401  (music-caption cannot start without it)
+    except ImportError:
+        return {"music-caption": {"skipped": "torch is not installed"}}
+    caption = stack.start("music-caption", os.path.join(SERVICES_DIR, "music-caption"), "main:app", {
+        "CAPTION_MODEL_FACTORY": "benchmarks.blap_standin:load",
+        "RESULT_CACHE_MAX_BYTES": "0",
+    }, ready_path="/ready")
+    clip = make_track(10)
+
+    async def request(client, index):
+        return await client.post(caption.url + "/music-caption", data={"prompt": "caption"},
+                                 files={"audios": ("clip.wav", clip, "audio/wav")})
+
+    return {"music-caption": asyncio.run(run_load(request, args.requests, args.concurrency))}
+
+def scenario_caption_workers(stack: Stack, args) -> dict:
+    """N pre-forked workers (serve.py) against N independent uvicorn processes: throughput
+    and the memory of all processes together (PSS, so shared weights count once)."""
+    try:
+        import torch  # noqa: F401
+    except ImportError:
+        return {"caption-workers": {"skipped": "torch is not installed"}}
+    caption_dir = os.path.join(SERVICES_DIR, "music-caption")
+    env = {"CAPTION_MODEL_FACTORY": args.caption_factory, "RESULT_CACHE_MAX_BYTES": "0"}
+    clip = make_track(10)
+    results = {}
+
+    def measure(urls: List[str]) -> dict:
+        async def request(client, index):
+            return await client.post(urls[index % len(urls)] + "/music-caption", data={"prompt": "caption"},
+                                     files={"audios": ("clip.wav", clip, "audio/wav")})
+
+        startups = {}
+        for url in urls * (4 * args.caption_workers):
+            status = httpx.get(url + "/ready").json()
+            startups[status["pid"]] = status["startup_seconds"]
+        result = asyncio.run(run_load(request, args.requests, args.concurrency))
+        result["worker_startup_seconds"] = sorted(value for value in startups.values() if value is not None)
+        result["total_pss_mb"] = sum(filter(None, stack.pss().values()))
+        return result
+
+    prefork = stack.start("caption-prefork", caption_dir, "", env, ready_path="/ready",
+                          command=["serve.py", "--workers", str(args.caption_workers), "--log-level", "warning"])
+    # /ready answers from whichever worker accepts first; give the others time to warm up
+    time.sleep(2)
+    results["caption-workers-prefork"] = measure([prefork.url])
+    prefork.stop()
+    del stack.services["caption-prefork"]
+
+    separate = [stack.start(f"caption-{index}", caption_dir, "main:app", env, ready_path="/ready")
+                for index in range(args.caption_workers)]
+    results["caption-workers-separate"] = measure([service.url for service in separate])
+    return results
+
+def scenario_caption_pipeline(stack: Stack, args) -> dict:
+    """Captioning stored tracks: the client's three hops (download, highlight, caption, then a
+    metadata update) against one call to the gateway's highlight-caption pipeline."""
+    try:
+        import torch  # noqa: F401
+    except ImportError:
+        return {"caption-pipeline": {"skipped": "torch is not installed"}}
+    repository = stack.start("repository", os.path.join(SERVICES_DIR, "repository"), "main:app", repository_env(stack))
+    analysis = stack.start("music-analysis", os.path.join(SERVICES_DIR, "music-analysis"), "main:app",
+                           {"REPOSITORY_URL": repository.url, "RESULT_CACHE_MAX_BYTES": "0"}, ready_path="/docs")
+    caption = stack.start("music-caption", os.path.join(SERVICES_DIR, "music-caption"), "main:app", {
+        "CAPTION_MODEL_FACTORY": args.caption_factory,
+        "RESULT_CACHE_MAX_BYTES": "0",
+    }, ready_path="/ready")
+    monitor = stack.stub("task-monitor-stub", "task-monitor")
+    gateway = stack.start("task-manager", os.path.join(SERVICES_DIR, "task-manager"), "main:app", {
+        "REPOSITORY_URL": repository.url,
+        "MUSIC_HIGHLIGHT_URL": analysis.url,
+        "MUSIC_CAPTION_URL": caption.url,
+        "TASK_MONITOR_URL": monitor.url,
+        "JOB_STORE_DIR": os.path.join(stack.work_dir, "jobs"),
+    }, ready_path="/docs")
+    paths = [f"tracks/{i}.wav" for i in range(args.batch_tracks)]
+    for i, path in enumerate(paths):
+        httpx.post(repository.url + "/files/upload", timeout=120.0,
+                   data={"file_path": path, "description": "track", "evaluation": "none", "additional_info": "{}"},
+                   files={"file": ("track.wav", make_track(args.track_seconds, seed=i), "audio/wav")}).raise_for_status()
+
+    async def client_hops(client, index):
+        path = paths[index % len(paths)]
+        track = await client.get(repository.url + "/files/download", params={"file_path": path})
+        highlight = await client.post(gateway.url + "/music-highlight", files={"audios": ("track.wav", track.content, "audio/wav")})
+        response = await client.post(gateway.url + "/music-caption", data={"prompt": "caption"},
+                                     files={"audios": ("highlight.wav", highlight.content, "audio/wav")})
+        if response.status_code != 200:
+            return response
+        return await client.put(repository.url + "/files/metadata",
+                                json={"file_path": path, "parameter_name": "description", "value": response.json()})
+
+    async def pipeline(client, index):
+        response = await client.post(gateway.url + "/pipelines/highlight-caption", json={"file_paths": paths})
+        if response.status_code == 200 and response.json()["failed"]:
+            raise RuntimeError(json.dumps(response.json()["results"])[:200])
+        return response
+
+    return {
+        "caption-client-hops": asyncio.run(run_load(client_hops, args.requests, args.concurrency)),
+        "caption-pipeline": asyncio.run(run_load(pipeline, max(1, args.requests // len(paths)), 1)),
+    }
+
+def caption_overlap(reference: str, candidate: str) -> float:
+    """Unigram F1 between two captions, a cheap stand-in for a caption quality metric."""
+    ref, cand = reference.lower().split(), candidate.lower().split()
+    common = sum(min(ref.count(word), cand.count(word)) for word in set(cand))
+    if not common:
+        return 0.0
+    precision, recall = common / len(cand), common / len(ref)
+    return 2 * precision * recall / (precision + recall)
+
+def scenario_caption_profiles(stack: Stack, args) -> dict:
+    """Latency of every inference profile, and how close its captions stay to the "quality" profile."""
+    try:
+        import torch  # noqa: F401
+    except ImportError:
+        return {"caption-profiles": {"skipped": "torch is not installed"}}
+    caption = stack.start("music-caption", os.path.join(SERVICES_DIR, "music-caption"), "main:app", {
+        "CAPTION_MODEL_FACTORY": args.caption_factory,
+        "CAPTION_ENABLED_PROFILES": args.caption_profiles,
+        "RESULT_CACHE_MAX_BYTES": "0",
+    }, ready_path="/ready")
+    profiles = list(httpx.get(caption.url + "/profiles").json()["profiles"])
+    clips = []
+    for path in args.caption_audio or []:
+        with open(path, "rb") as f:
+            clips.append((os.path.basename(path), f.read()))
+    clips = clips or [(f"clip{seed}.wav", make_track(10, seed=seed)) for seed in range(4)]
+
+    def captions_for(profile: str) -> List[str]:
+        files = [("audios", (name, data, "audio/wav")) for name, data in clips]
+        response = httpx.post(caption.url + "/music-caption", params={"profile": profile}, data={"prompt": "caption"},
+                              files=files, timeout=600.0)
+        response.raise_for_status()
+        results = response.json()
+        return [result["caption"] for result in results["results"]] if isinstance(results, dict) else [results]
+
+    reference = captions_for("quality") if "quality" in profiles else None
+    results = {}
+    for profile in profiles:
+        async def request(client, index, profile=profile):
+            name, data = clips[index % len(clips)]
+            return await client.post(caption.url + "/music-caption", params={"profile": profile},
+                                     data={"prompt": "caption"}, files={"audios": (name, data, "audio/wav")})
+
+        result = asyncio.run(run_load(request, args.requests, args.concurrency))
+        if reference is not None:
+            captions = captions_for(profile)
+            result["caption_overlap_vs_quality"] = sum(map(caption_overlap, reference, captions)) / len(captions)
+            result["caption_samples"] = captions[:2]
+        results[f"caption-profile-{profile}"] = result
+    return results
+
+SCENARIOS = {
+    "vqa": scenario_vqa,
+    "repository-large-file": scenario_repository_large_file,
+    "repository-history": scenario_repository_history,
+    "highlight-batch": scenario_highlight_batch,
+    "music-caption": scenario_music_caption,
+    "caption-profiles": scenario_caption_profiles,
+    "caption-workers": scenario_caption_workers,
+    "caption-pipeline": scenario_caption_pipeline,
+}
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(names: List[str], args) -> dict:
+    report = {
+        "meta": {
+            "run_id": uuid.uuid4().hex,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": {key: value for key, value in vars(args).items() if key not in ("scenarios", "compare", "output")},
+        },
+        "results": {},
+    }
+    for name in names:
+        print(f"== {name}", file=sys.stderr)
+        stack = Stack()
+        try:
+            results = SCENARIOS[name](stack, args)
+            rss = stack.peak_rss()
+            for result in results.values():
+                result.setdefault("peak_rss_mb", rss)
+        except Exception as e:
+            print(f"Scenario {name} failed: {e}", file=sys.stderr)
+            results = {name: {"failed": str(e)}}
+        finally:
+            stack.close()
+        report["results"].update(results)
+        for result_name, result in results.items():
+            latency = result.get("latency_ms")
+            if latency and latency["p50"] is not None:
+                print(f"   {result_name}: {result['throughput_rps']:.1f} req/s, p50 {latency['p50']:.1f} ms, "
+                      f"p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms, errors {result['errors']}",
+                      file=sys.stderr)
+    return report
+
+# Lower is better for these, higher for the rest
+LOWER_IS_BETTER = ("latency_ms", "peak_rss_mb", "total_pss_mb", "errors")
+
+def compare(old_path: str, new_path: str):
+    with open(old_path) as f:
+        old = json.load(f)["results"]
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    print(f"{'result':28} {'metric':24} {'old':>12} {'new':>12} {'change':>9}")
+    for name in sorted(set(old) & set(new)):
+        rows = [("throughput_rps", old[name].get("throughput_rps"), new[name].get("throughput_rps")),
+                ("errors", old[name].get("errors"), new[name].get("errors")),
+                ("caption_overlap", old[name].get("caption_overlap_vs_quality"), new[name].get("caption_overlap_vs_quality"))]
+        for q in ("p50", "p95", "p99"):
+            rows.append((f"latency_ms.{q}", old[name].get("latency_ms", {}).get(q), new[name].get("latency_ms", {}).get(q)))
+        rows.append(("total_pss_mb", old[name].get("total_pss_mb"), new[name].get("total_pss_mb")))
+        for process in sorted(set(old[name].get("peak_rss_mb") or {}) & set(new[name].get("peak_rss_mb") or {})):
+            rows.append((f"peak_rss_mb.{process}", old[name]["peak_rss_mb"][process], new[name]["peak_rss_mb"][process]))
+        for metric, before, after in rows:
+            if before is None or after is None:
+                continue
+            if not before:
+                print(f"{name:28} {metric:24} {before:12.2f} {after:12.2f} {'n/a':>9}")
+                continue
+            change = (after - before) / before * 100
+            # "!" marks a regression
+            better = (change < 0) == metric.startswith(LOWER_IS_BETTER) or change == 0
+            print(f"{name:28} {metric:24} {before:12.2f} {after:12.2f} {change:+8.1f}%{'' if better else ' !'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end service benchmarks")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--large-file-mb", type=int, default=64)
+    parser.add_argument("--history-versions", type=int, default=20)
+    parser.add_argument("--batch-tracks", type=int, default=8)
+    parser.add_argument("--track-seconds", type=float, default=60)
+    parser.add_argument("--caption-profiles", default="all", help="profiles compared by caption-profiles")
+    parser.add_argument("--caption-factory", default="benchmarks.blap_standin:load",
+                        help='CAPTION_MODEL_FACTORY for caption-profiles; "" loads BLAP2 from BLAP_CHECKPOINT_PATH')
+    parser.add_argument("--caption-workers", type=int, default=4, help="worker processes for caption-workers")
+    parser.add_argument("--caption-audio", nargs="*", help="clips for caption-profiles (default: synthetic)")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    report = run(args.scenarios or list(SCENARIOS), args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Local stand-ins for the external backends, so services can be benchmarked offline.
+
+    python -m benchmarks.stubs vlm --port 9101
+    python -m benchmarks.stubs task-monitor --port 9102
+
+STUB_LATENCY_MS adds a fixed delay per request, STUB_TOKENS sets the answer length.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "50"))
+STUB_TOKENS = int(os.getenv("STUB_TOKENS", "32"))
+
+def create_vlm_app() -> FastAPI:
+    """OpenAI-compatible /v1/chat/completions that answers with canned tokens."""
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(STUB_LATENCY_MS / 1000)
+        tokens = [f"token{i} " for i in range(min(STUB_TOKENS, body.get("max_tokens") or STUB_TOKENS))]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "stub")
+        if body.get("stream"):
+            async def events():
+                for token in tokens:
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": len(tokens), "total_tokens": len(tokens) + 1},
+        }
+
+    return app
+
+def create_task_monitor_app() -> FastAPI:
+    """Accepts /api/task registrations and hands out session cookies."""
+    app = FastAPI()
+    tasks = []
+
+    @app.get("/init-session")
+    async def init_session():
+        return JSONResponse({"ok": True}, headers={"Set-Cookie": f"sid={uuid.uuid4().hex}; Path=/"})
+
+    @app.post("/api/task")
+    async def add_task(request: Request):
+        tasks.append(await request.json())
+        return {"id": len(tasks)}
+
+    @app.get("/api/task/count")
+    async def task_count():
+        return {"count": len(tasks)}
+
+    return app
+
+STUBS = {"vlm": create_vlm_app, "task-monitor": create_task_monitor_app}
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Run a stand-in backend")
+    parser.add_argument("stub", choices=sorted(STUBS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+    uvicorn.run(STUBS[args.stub](), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,156 @@
+import io
+import json
+import time
+import zipfile
+from dataclasses import dataclass, asdict
+from typing import List, Tuple
+import numpy as np
+import soundfile as sf
+import librosa
+
+@dataclass
+class HighlightParams:
+    target_sr: int = 48000
+    window_seconds: float = 10
+    count: int = 1  # number of non-overlapping windows to return, best first
+    frame_length: int = 2048
+    hop_length: int = 512
+    onset_weight: float = 0.0  # 0 = RMS only, 1 = onset strength (spectral flux) only
+
+    def cache_params(self) -> dict:
+        return asdict(self)
+
+def window_sums(scores: np.ndarray, window_frames: int) -> np.ndarray:
+    """Sum of every window of window_frames consecutive scores in O(frames) via a prefix sum."""
+    prefix = np.concatenate(([0.0], np.cumsum(scores, dtype=np.float64)))
+    if len(scores) < window_frames:
+        # Track shorter than one window: the only candidate is the whole track
+        return prefix[-1:]
+    return prefix[window_frames:] - prefix[:-window_frames]
+
+def top_k_windows(sums: np.ndarray, window_frames: int, count: int) -> List[int]:
+    """Start frames of the `count` best non-overlapping windows, best first."""
+    sums = np.array(sums, dtype=np.float64)
+    starts = []
+    for _ in range(max(1, count)):
+        idx = int(np.argmax(sums))
+        if not np.isfinite(sums[idx]):
+            break
+        starts.append(idx)
+        # Any window starting closer than window_frames would overlap this one
+        sums[max(0, idx - window_frames + 1):idx + window_frames] = -np.inf
+    return starts
+
+def _normalise(values: np.ndarray) -> np.ndarray:
+    peak = float(np.max(values)) if len(values) else 0.0
+    return values / peak if peak > 0 else values
+
+def frame_scores(y: np.ndarray, sr: int, params: HighlightParams) -> np.ndarray:
+    rms = librosa.feature.rms(y=y, frame_length=params.frame_length, hop_length=params.hop_length)[0]
+    if params.onset_weight <= 0:
+        return rms
+    onset = librosa.onset.onset_strength(y=y, sr=sr, hop_length=params.hop_length)
+    n = min(len(rms), len(onset))
+    return (1 - params.onset_weight) * _normalise(rms[:n]) + params.onset_weight * _normalise(onset[:n])
+
+def full_highlights(file, params: HighlightParams) -> Tuple[List[Tuple[float, np.ndarray]], int]:
+    """Load the whole track and return [(start_seconds, segment), ...] for the best windows."""
+    # Load audio from memory
+    y, sr = librosa.load(file, sr=params.target_sr)
+
+    scores = frame_scores(y, sr, params)
+    window_frames = max(1, int(params.window_seconds * sr / params.hop_length))
+    starts = top_k_windows(window_sums(scores, window_frames), window_frames, params.count)
+    window_samples = int(params.window_seconds * sr)
+    clips = []
+    for start_frame in starts:
+        start_sample = start_frame * params.hop_length
+        clips.append((start_sample / sr, y[start_sample:start_sample + window_samples]))
+    return clips, sr
+
+def _frame_rms(buf: np.ndarray, n_frames: int, frame_length: int, hop_length: int) -> np.ndarray:
+    # RMS of every frame via a cumulative sum of squares: O(samples) regardless of frame length
+    squares = np.concatenate(([0.0], np.cumsum(np.square(buf, dtype=np.float64))))
+    starts = np.arange(n_frames) * hop_length
+    return np.sqrt((squares[starts + frame_length] - squares[starts]) / frame_length)
+
+def stream_highlights(file, params: HighlightParams, block_hops: int = 1024) -> Tuple[List[Tuple[float, np.ndarray]], int]:
+    """Find the best windows by decoding the file block by block.
+
+    Only the current block and one float32 RMS value per hop are held in memory; the
+    winning windows are decoded again at the end and resampled on their own, so the
+    decoded track is never materialised. Scores are RMS only (onset_weight is ignored).
+    """
+    with sf.SoundFile(file) as snd:
+        native_sr = snd.samplerate
+        # Keep the analysis resolution of the target-rate path at the file's native rate
+        scale = native_sr / params.target_sr
+        hop = max(1, int(round(params.hop_length * scale)))
+        frame = max(hop, int(round(params.frame_length * scale)))
+        window_frames = max(1, int(params.window_seconds * native_sr / hop))
+
+        carry = np.zeros(0, dtype=np.float32)
+        rms_blocks = []
+        for block in snd.blocks(blocksize=hop * block_hops, dtype='float32', always_2d=True):
+            buf = np.concatenate((carry, block.mean(axis=1)))
+            if len(buf) < frame:
+                carry = buf
+                continue
+            n_frames = (len(buf) - frame) // hop + 1
+            rms_blocks.append(_frame_rms(buf, n_frames, frame, hop).astype(np.float32))
+            carry = buf[n_frames * hop:]
+        scores = np.concatenate(rms_blocks) if rms_blocks else np.zeros(1, dtype=np.float32)
+        starts = top_k_windows(window_sums(scores, window_frames), window_frames, params.count)
+
+        # Decode only the winning windows
+        clips = []
+        for start_frame in starts:
+            snd.seek(start_frame * hop)
+            segment = snd.read(int(params.window_seconds * native_sr), dtype='float32', always_2d=True).mean(axis=1)
+            if native_sr != params.target_sr:
+                segment = librosa.resample(segment, orig_sr=native_sr, target_sr=params.target_sr)
+            clips.append((start_frame * hop / native_sr, segment))
+    return clips, params.target_sr
+
+def pack_clips(clips: List[Tuple[float, bytes]]) -> bytes:
+    """Store encoded clips and their start times as one (uncompressed) zip archive."""
+    out_buf = io.BytesIO()
+    with zipfile.ZipFile(out_buf, "w", compression=zipfile.ZIP_STORED) as archive:
+        for i, (_, wav) in enumerate(clips):
+            archive.writestr(f"highlight.{i}.wav", wav)
+        archive.writestr("clips.json", json.dumps([
+            {"file": f"highlight.{i}.wav", "start_seconds": start} for i, (start, _) in enumerate(clips)
+        ]))
+    return out_buf.getvalue()
+
+def unpack_clips(data: bytes) -> List[Tuple[float, bytes]]:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        entries = json.loads(archive.read("clips.json"))
+        return [(entry["start_seconds"], archive.read(entry["file"])) for entry in entries]
+
+def highlight_to_wav(file, params: HighlightParams, streaming: bool = False) -> dict:
+    """Worker entry point: file in, WAV-encoded clips (start_seconds, bytes) and timings out."""
+    started = time.perf_counter()
+    clips = None
+    if streaming:
+        try:
+            clips, sr = stream_highlights(file, params)
+        except sf.LibsndfileError as e:
+            # Formats libsndfile cannot decode still go through librosa's fallback decoders
+            print(f"Streaming decode failed, loading whole file: {e}")
+            if hasattr(file, "seek"):
+                file.seek(0)
+    if clips is None:
+        clips, sr = full_highlights(file, params)
+    analysed = time.perf_counter()
+    encoded = []
+    for start, segment in clips:
+        out_buf = io.BytesIO()
+        sf.write(out_buf, segment, sr, format='WAV')
+        encoded.append((start, out_buf.getvalue()))
+    finished = time.perf_counter()
+    return {
+        "clips": encoded,
+        "analysis_seconds": analysed - started,
+        "encode_seconds": finished - analysed,
+    }
@@ -1,37 +1,273 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.responses import StreamingResponse
-import librosa
-import numpy as np
-import soundfile as sf
+from starlette.background import BackgroundTask
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import asyncio
+import httpx
+import json
+import pathlib
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
 import io
+import os
+import sys
 
-app = FastAPI()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../shared")))
+from result_cache import ResultCache, make_cache_key, hash_file
+from instrumentation import instrument_app, observe_stage, stage, trace_headers
+from highlight import HighlightParams, highlight_to_wav, pack_clips, unpack_clips
+
+HIGHLIGHT_SAMPLE_RATE = 48000
+HIGHLIGHT_SECONDS = 10
+HIGHLIGHT_MAX_COUNT = int(os.getenv("HIGHLIGHT_MAX_COUNT", "16"))
+# Uploads at least this large are analysed block by block unless the caller says otherwise
+HIGHLIGHT_STREAMING_MIN_BYTES = int(os.getenv("HIGHLIGHT_STREAMING_MIN_BYTES", str(64 * 1024 * 1024)))
+HIGHLIGHT_BATCH_WORKERS = int(os.getenv("HIGHLIGHT_BATCH_WORKERS", str(os.cpu_count() or 1)))
+REPOSITORY_URL = os.getenv("REPOSITORY_URL", "http://localhost:8103")
+
+process_pool = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global process_pool
+    process_pool = ProcessPoolExecutor(max_workers=HIGHLIGHT_BATCH_WORKERS)
+    yield
+    process_pool.shutdown(cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app, "music-analysis")
+result_cache = ResultCache.from_env()
+
+def make_params(count: int, window_seconds: float, hop_length: int, frame_length: int, onset_weight: float) -> HighlightParams:
+    if not 1 <= count <= HIGHLIGHT_MAX_COUNT:
+        raise HTTPException(status_code=400, detail=f"count must be between 1 and {HIGHLIGHT_MAX_COUNT}")
+    if window_seconds <= 0 or hop_length <= 0 or frame_length < hop_length:
+        raise HTTPException(status_code=400, detail="window_seconds and hop_length must be positive and frame_length >= hop_length")
+    if not 0 <= onset_weight <= 1:
+        raise HTTPException(status_code=400, detail="onset_weight must be between 0 and 1")
+    return HighlightParams(HIGHLIGHT_SAMPLE_RATE, window_seconds, count, frame_length, hop_length, onset_weight)
+
+def highlight_cache_key(file, params: HighlightParams, streaming: bool) -> str:
+    with stage("hash"):
+        return make_cache_key(hash_file(file), streaming=streaming, **params.cache_params())
+
+def highlight_file_cache_key(path: str, params: HighlightParams, streaming: bool) -> str:
+    with open(path, "rb") as f:
+        return highlight_cache_key(f, params, streaming)
+
+def observe_highlight_timings(result: dict):
+    # highlight_to_wav may run in a worker process; its timings are recorded here
+    observe_stage("analysis", result["analysis_seconds"])
+    observe_stage("encode", result["encode_seconds"])
+
+def highlight_response(archive: bytes, params: HighlightParams, cache_status: str) -> StreamingResponse:
+    if params.count > 1:
+        return StreamingResponse(io.BytesIO(archive), media_type="application/zip", headers={
+            "Content-Disposition": "attachment; filename=highlights.zip",
+            "X-Cache": cache_status
+        })
+    start_seconds, wav = unpack_clips(archive)[0]
+    return StreamingResponse(io.BytesIO(wav), media_type="audio/wav", headers={
+        "Content-Disposition": "attachment; filename=highlight.wav",
+        "X-Highlight-Start": f"{start_seconds:.3f}",
+        "X-Cache": cache_status
+    })
 
 @app.post("/music-highlight")
-async def extract_highlight(audios: UploadFile = File(...)):
-    # Read uploaded file into memory
-    contents = await audios.read()
-    audio_buf = io.BytesIO(contents)
-
-    # Load audio from memory
-    y, sr = librosa.load(audio_buf, sr=48000)
-
-    # Compute RMS energy
-    hop_length = 512
-    rms = librosa.feature.rms(y=y, frame_length=2048, hop_length=hop_length)[0]
-    frames_per_sec = sr / hop_length
-    window_size = int(10 * frames_per_sec)
-    energies = np.convolve(rms, np.ones(window_size), mode='valid')
-    start_frame = np.argmax(energies)
-    start_sample = start_frame * hop_length
-    end_sample = start_sample + int(10 * sr)
-    highlight = y[start_sample:end_sample]
-
-    # Save highlight to memory buffer
+async def extract_highlight(
+    audios: Optional[UploadFile] = File(None),
+    file_path: Optional[str] = None,
+    streaming: Optional[bool] = None,
+    count: int = 1,
+    window_seconds: float = HIGHLIGHT_SECONDS,
+    hop_length: int = 512,
+    frame_length: int = 2048,
+    onset_weight: float = 0.0,
+):
+    """Return the loudest window as WAV, or with count > 1 a zip of the best non-overlapping windows.
+
+    The track is either uploaded or, with file_path, fetched straight from the repository.
+    """
+    params = make_params(count, window_seconds, hop_length, frame_length, onset_weight)
+    if not file_path and audios is None:
+        raise HTTPException(status_code=400, detail="Upload audios or give a file_path")
+    # Spooled to a temp file and analysed in the process pool: even the block-by-block
+    # streaming mode for hour-long tracks never runs on the event loop
+    work_dir = tempfile.mkdtemp(prefix="highlight-")
+    try:
+        if file_path:
+            name = file_path
+            async with httpx.AsyncClient(timeout=120.0) as client:
+                path = await spool_repository_file(client, file_path, work_dir, 0)
+        else:
+            name = audios.filename or "upload"
+            path = await spool_upload(audios, work_dir, 0)
+        track = await process_track(0, name, path, params, streaming)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if "error" in track:
+        raise HTTPException(status_code=422, detail=f"Highlight extraction failed for {name}: {track['error']}")
+    return highlight_response(pack_clips(track["clips"]), params, track["cache"])
+
+async def spool_upload(upload: UploadFile, work_dir: str, index: int) -> str:
+    # Worker processes get a path on disk instead of pickled audio bytes
+    path = os.path.join(work_dir, f"{index:04d}{pathlib.PurePosixPath(upload.filename or '').suffix}")
+    def copy():
+        upload.file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(upload.file, f, 1024 * 1024)
+    await asyncio.to_thread(copy)
+    return path
+
+async def spool_repository_file(client: httpx.AsyncClient, file_path: str, work_dir: str, index: int) -> str:
+    path = os.path.join(work_dir, f"{index:04d}{pathlib.PurePosixPath(file_path).suffix}")
+    with stage("upstream_proxy", target="repository"):
+        async with client.stream("GET", f"{REPOSITORY_URL}/files/download", params={"file_path": file_path},
+                                 headers=trace_headers()) as response:
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=f"Could not fetch {file_path} from repository")
+            # Disk writes go through worker threads, like every other file access here
+            f = await asyncio.to_thread(open, path, "wb")
+            try:
+                async for chunk in response.aiter_bytes(1024 * 1024):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    return path
+
+def fetch_error(error: BaseException) -> str:
+    if isinstance(error, HTTPException):
+        return f"HTTP {error.status_code}: {error.detail}"
+    return repr(error)
+
+async def process_track(index: int, name: str, path, params: HighlightParams, streaming: Optional[bool]) -> dict:
+    """Highlight one spooled track; path may be the exception that prevented spooling it."""
+    started = time.perf_counter()
+    if isinstance(path, BaseException):
+        return {"index": index, "name": name, "cache": "MISS", "error": fetch_error(path), "total_seconds": 0.0}
+    if streaming is None:
+        streaming = os.path.getsize(path) >= HIGHLIGHT_STREAMING_MIN_BYTES
+    track = {"index": index, "name": name, "cache": "MISS"}
+    try:
+        cache_key = await asyncio.to_thread(highlight_file_cache_key, path, params, streaming)
+        archive = await result_cache.get_async(cache_key)
+        if archive is not None:
+            track["cache"] = "HIT"
+            track["clips"] = unpack_clips(archive)
+        else:
+            submitted = time.perf_counter()
+            result = await asyncio.get_running_loop().run_in_executor(
+                process_pool, highlight_to_wav, path, params, streaming)
+            observe_highlight_timings(result)
+            track.update(result)
+            # Time the track waited for a free worker (plus the hand-over), not spent analysing it
+            track["queue_seconds"] = max(0.0, time.perf_counter() - submitted
+                                         - result["analysis_seconds"] - result["encode_seconds"])
+            await result_cache.put_async(cache_key, pack_clips(track["clips"]))
+    except Exception as e:
+        print(f"Highlight extraction failed for {name}: {e!r}")
+        # Decoder errors often have an empty str()
+        track["error"] = repr(e)
+    track["total_seconds"] = time.perf_counter() - started
+    return track
+
+def highlight_entry_name(track: dict, clip_index: int) -> str:
+    stem = f"{track['index']:04d}_{pathlib.PurePosixPath(track['name']).stem}"
+    if len(track["clips"]) == 1:
+        return f"{stem}.highlight.wav"
+    return f"{stem}.highlight.{clip_index}.wav"
+
+def manifest_entry(track: dict) -> dict:
+    entry = {k: v for k, v in track.items() if k != "clips"}
+    if "clips" in track:
+        entry["clips"] = [
+            {"file": highlight_entry_name(track, i), "start_seconds": start}
+            for i, (start, _) in enumerate(track["clips"])
+        ]
+    return entry
+
+@app.post("/music-highlight/batch")
+async def extract_highlight_batch(
+    audios: List[UploadFile] = File([]),
+    file_paths: List[str] = Form([]),
+    response_format: str = Form("zip"),
+    streaming: Optional[bool] = Form(None),
+    count: int = Form(1),
+    window_seconds: float = Form(HIGHLIGHT_SECONDS),
+    hop_length: int = Form(512),
+    frame_length: int = Form(2048),
+    onset_weight: float = Form(0.0),
+):
+    """Extract highlights for many tracks at once, spread across the process pool.
+
+    Tracks come from uploads and/or repository paths. The result is a zip with one WAV per
+    track plus manifest.json, or a multipart/mixed stream that emits each track as it finishes.
+    """
+    if response_format not in ("zip", "multipart"):
+        raise HTTPException(status_code=400, detail="response_format must be 'zip' or 'multipart'")
+    if not audios and not file_paths:
+        raise HTTPException(status_code=400, detail="No audios or file_paths given")
+    params = make_params(count, window_seconds, hop_length, frame_length, onset_weight)
+    started = time.perf_counter()
+    work_dir = tempfile.mkdtemp(prefix="highlight-batch-")
+    try:
+        sources = []
+        for upload in audios:
+            sources.append((upload.filename or "upload", await spool_upload(upload, work_dir, len(sources))))
+        if file_paths:
+            async with httpx.AsyncClient(timeout=120.0) as client:
+                offset = len(sources)
+                # A path that cannot be fetched is reported in its own track entry, like a failed analysis
+                paths = await asyncio.gather(*[
+                    spool_repository_file(client, file_path, work_dir, offset + i)
+                    for i, file_path in enumerate(file_paths)
+                ], return_exceptions=True)
+            sources.extend(zip(file_paths, paths))
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    tasks = [asyncio.create_task(process_track(i, name, path, params, streaming)) for i, (name, path) in enumerate(sources)]
+    cleanup = BackgroundTask(shutil.rmtree, work_dir, ignore_errors=True)
+
+    if response_format == "multipart":
+        boundary = uuid.uuid4().hex
+
+        async def multipart_stream():
+            for finished in asyncio.as_completed(tasks):
+                track = await finished
+                headers = f"--{boundary}\r\nContent-Type: application/json\r\n\r\n"
+                yield headers.encode() + json.dumps(manifest_entry(track)).encode() + b"\r\n"
+                for i, (_, wav) in enumerate(track.get("clips", [])):
+                    headers = (f"--{boundary}\r\nContent-Type: audio/wav\r\n"
+                               f"Content-Disposition: attachment; filename={highlight_entry_name(track, i)}\r\n\r\n")
+                    yield headers.encode() + wav + b"\r\n"
+            yield f"--{boundary}--\r\n".encode()
+
+        return StreamingResponse(multipart_stream(), media_type=f"multipart/mixed; boundary={boundary}",
+                                 background=cleanup)
+
+    tracks = await asyncio.gather(*tasks)
     out_buf = io.BytesIO()
-    sf.write(out_buf, highlight, sr, format='WAV')
+    # WAV does not compress well, store it as is
+    with zipfile.ZipFile(out_buf, "w", compression=zipfile.ZIP_STORED) as archive:
+        for track in tracks:
+            for i, (_, wav) in enumerate(track.get("clips", [])):
+                archive.writestr(highlight_entry_name(track, i), wav)
+        archive.writestr("manifest.json", json.dumps({
+            "tracks": [manifest_entry(track) for track in tracks],
+            "total_seconds": time.perf_counter() - started,
+            "workers": HIGHLIGHT_BATCH_WORKERS,
+        }, indent=2))
     out_buf.seek(0)
+    return StreamingResponse(out_buf, media_type="application/zip", headers={
+        "Content-Disposition": "attachment; filename=highlights.zip"
+    }, background=cleanup)
 
-    return StreamingResponse(out_buf, media_type="audio/wav", headers={
-        "Content-Disposition": "attachment; filename=highlight.wav"
-    })
\ No newline at end of file
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
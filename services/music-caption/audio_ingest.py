@@ -0,0 +1,51 @@
+import io
+from dataclasses import dataclass
+from typing import List
+import numpy as np
+import soundfile as sf
+import torch
+
+from model_manager import MODEL_SAMPLE_RATE
+
+def decode_audio(data: bytes, target_sr: int = MODEL_SAMPLE_RATE) -> torch.Tensor:
+    """Decode to a 1-D float32 tensor at target_sr.
+
+    libsndfile converts straight to float32 (no float64 intermediate), mono files are
+    used as a view of the decoded buffer and torch.from_numpy shares that memory, so the
+    only copies are the decode itself, a downmix of multi-channel audio and resampling.
+    """
+    audio, sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    if audio.shape[1] == 1:
+        mono = audio[:, 0]
+    else:
+        mono = audio.mean(axis=1, dtype=np.float32)
+    samples = torch.from_numpy(np.ascontiguousarray(mono))
+    if sr != target_sr:
+        import torchaudio.functional
+        samples = torchaudio.functional.resample(samples, sr, target_sr)
+    return samples
+
+@dataclass
+class Segment:
+    start_seconds: float
+    end_seconds: float
+    audio: torch.Tensor  # view into the track, not a copy
+
+def split_windows(samples: torch.Tensor, window_seconds: float, hop_seconds: float,
+                  sr: int = MODEL_SAMPLE_RATE) -> List[Segment]:
+    """Cut a track into model-sized windows every hop_seconds.
+
+    All windows have the same length, so the batcher can stack them into one forward
+    pass. A remainder of at least half a window gets one more window aligned to the end
+    of the track; a track shorter than one window is a single segment of its own length.
+    """
+    window = int(window_seconds * sr)
+    hop = max(1, int(hop_seconds * sr))
+    total = samples.shape[-1]
+    if total <= window:
+        return [Segment(0.0, total / sr, samples)]
+    starts = list(range(0, total - window + 1, hop))
+    covered = starts[-1] + window
+    if total - covered >= window // 2:
+        starts.append(total - window)
+    return [Segment(start / sr, (start + window) / sr, samples[start:start + window]) for start in starts]
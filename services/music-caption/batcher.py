@@ -0,0 +1,103 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import torch
+
+from model_manager import ModelManager, Stopwatch
+from inference_profiles import InferenceProfile
+
+@dataclass
+class CaptionJob:
+    audio: torch.Tensor  # 1-D float tensor at the model sample rate
+    prompt: str
+    profile: InferenceProfile
+    future: asyncio.Future = field(repr=False, default=None)
+
+    def group_key(self):
+        # Only clips that can be stacked and decoded with the same settings share a forward pass
+        return (self.audio.shape[-1], self.prompt, self.profile)
+
+class BatchScheduler:
+    """Collects concurrent caption requests into batches and runs them on a worker thread."""
+    def __init__(self, model_manager: ModelManager, max_batch_size: int = 8, max_wait_ms: float = 20, max_queue: int = 256):
+        self.model_manager = model_manager
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+        self.queue = None
+        self._task = None
+        # One inference thread: torch already parallelises inside a forward pass
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption-infer")
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, audio: torch.Tensor, prompt: str, profile: InferenceProfile) -> str:
+        if self.queue is None:
+            raise RuntimeError("Batch scheduler is not running")
+        job = CaptionJob(audio.reshape(-1), prompt, profile)
+        job.future = asyncio.get_running_loop().create_future()
+        await self.queue.put(job)
+        return await job.future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups = {}
+            for job in batch:
+                groups.setdefault(job.group_key(), []).append(job)
+            for jobs in groups.values():
+                jobs = [job for job in jobs if not job.future.done()]
+                if not jobs:
+                    continue
+                try:
+                    outputs = await loop.run_in_executor(self._executor, self._predict, jobs)
+                except Exception as e:
+                    print(f"Error during prediction: {e}")
+                    for job in jobs:
+                        if not job.future.done():
+                            job.future.set_exception(e)
+                    continue
+                for job, output in zip(jobs, outputs):
+                    if not job.future.done():
+                        job.future.set_result(output)
+
+    def _predict(self, jobs):
+        first = jobs[0]
+        profile = first.profile
+        model = self.model_manager.get(profile)
+        audio_batch = torch.stack([job.audio for job in jobs])
+        with Stopwatch(f"Batch inference ({len(jobs)} clips, {profile.name})", stage="inference"):
+            with torch.no_grad(), self.model_manager.autocast(profile):
+                return model.predict_answers(
+                    audio_batch,
+                    first.prompt,
+                    max_len=profile.max_len,
+                    min_len=profile.min_len,
+                    num_beams=profile.num_beams
+                )
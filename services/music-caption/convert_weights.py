@@ -0,0 +1,37 @@
+"""Convert the BLAP2 checkpoint into a file the service can memory-map.
+
+    python convert_weights.py /models/blap2.pt
+    CAPTION_WEIGHTS_PATH=/models/blap2.pt python serve.py --workers 4
+
+The checkpoint is loaded once the usual way (BLAP_CHECKPOINT_PATH / BLAP_MODEL_CONFIG_PATH,
+or CAPTION_MODEL_FACTORY) and the ready-to-use eval model is saved with torch.save. Loading
+that file with torch.load(mmap=True) skips checkpoint parsing and reads no weights up front;
+all processes on the node share its pages through the page cache.
+"""
+import argparse
+import os
+import torch
+
+from model_manager import Stopwatch, load_mmap_model, resolve_model_factory
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the caption model for memory-mapped loading")
+    parser.add_argument("output", help="file to write, e.g. /models/blap2.pt")
+    parser.add_argument("--checkpoint", default=os.getenv("BLAP_CHECKPOINT_PATH", "checkpoint.ckpt"))
+    parser.add_argument("--model-config", default=os.getenv("BLAP_MODEL_CONFIG_PATH", "config.json"))
+    parser.add_argument("--factory", default=os.getenv("CAPTION_MODEL_FACTORY", ""),
+                        help='"module:function" building the model (default: the BLAP2 loader)')
+    args = parser.parse_args()
+
+    with Stopwatch("Checkpoint load"):
+        model = resolve_model_factory(args.factory)(args.checkpoint, args.model_config).eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+    with Stopwatch("Save"):
+        torch.save(model, args.output)
+    with Stopwatch("Memory-mapped load"):
+        load_mmap_model(args.output)
+    print(f"Wrote {args.output} ({os.path.getsize(args.output) / (1024 * 1024):.1f} MiB)")
+
+if __name__ == "__main__":
+    main()
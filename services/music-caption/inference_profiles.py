@@ -0,0 +1,61 @@
+import json
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+@dataclass(frozen=True)
+class InferenceProfile:
+    """How one caption is computed: decoding settings plus the model variant it runs on.
+
+    quantize: dynamic int8 quantisation of the nn.Linear layers.
+    compile: "" (eager), "inductor" (torch.compile) or "torchscript", applied to the audio encoder.
+    bf16: run the forward pass under bfloat16 autocast (skipped on CPUs without native bf16).
+    """
+    name: str
+    num_beams: int = 10
+    max_len: int = 40
+    min_len: int = 30
+    quantize: bool = False
+    compile: str = ""
+    bf16: bool = False
+
+    def __post_init__(self):
+        if self.compile not in ("", "inductor", "torchscript"):
+            raise ValueError(f"Profile {self.name}: compile must be '', 'inductor' or 'torchscript'")
+        if self.quantize and self.bf16:
+            # Dynamically quantised linears only take float32 activations
+            raise ValueError(f"Profile {self.name}: quantize and bf16 cannot be combined")
+        if self.num_beams < 1 or self.min_len > self.max_len:
+            raise ValueError(f"Profile {self.name}: needs num_beams >= 1 and min_len <= max_len")
+
+    @property
+    def variant(self) -> tuple:
+        # Profiles that only differ in decoding settings or autocast share one copy of the weights
+        return (self.quantize, self.compile)
+
+    def settings(self) -> dict:
+        return {key: value for key, value in asdict(self).items() if key != "name"}
+
+BUILTIN_PROFILES = {
+    # The original settings
+    "quality": InferenceProfile("quality"),
+    "balanced": InferenceProfile("balanced", num_beams=3, quantize=True),
+    "fast": InferenceProfile("fast", num_beams=1, max_len=30, min_len=10, quantize=True, compile="inductor"),
+    "bf16": InferenceProfile("bf16", num_beams=3, bf16=True),
+}
+
+def load_profiles(extra_json: str = "") -> Dict[str, InferenceProfile]:
+    """The built-in profiles, extended or overridden by {"name": {"num_beams": 2, ...}}."""
+    profiles = dict(BUILTIN_PROFILES)
+    for name, settings in (json.loads(extra_json) if extra_json else {}).items():
+        profiles[name] = InferenceProfile(name, **settings)
+    return profiles
+
+def enabled_profile_names(spec: str, default: str, profiles: Dict[str, InferenceProfile]) -> List[str]:
+    """Comma-separated names, or "all"; the default profile is always enabled."""
+    names = list(profiles) if spec.strip() == "all" else [name.strip() for name in spec.split(",") if name.strip()]
+    if default not in names:
+        names.insert(0, default)
+    unknown = [name for name in names if name not in profiles]
+    if unknown:
+        raise ValueError(f"Unknown inference profiles: {', '.join(unknown)}")
+    return names
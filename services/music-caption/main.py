@@ -1,76 +1,167 @@
 # Init ialize the model
+import asyncio
+import json
 import os
 import sys
-from typing import List
+from contextlib import asynccontextmanager
+from typing import List, Optional
 import soundfile as sf
-import numpy as np
 import torch
-import time
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form
 from pydantic import BaseModel
 from fastapi.responses import JSONResponse
 import httpx
 
-import time
 import platform
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../externals/blap")))
-from blap.model.BLAP2.BLAP2_Pretrain import BLAP2_Stage2
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../shared")))
+from result_cache import ResultCache, make_cache_key, hash_bytes
+from instrumentation import instrument_app
+from model_manager import ModelManager, Stopwatch, CAPTION_PROMPT, MODEL_SAMPLE_RATE, configure_threads, resolve_model_factory
+from inference_profiles import InferenceProfile, enabled_profile_names, load_profiles
+from batcher import BatchScheduler
+from audio_ingest import decode_audio, split_windows
 
-app = FastAPI()
+CHECKPOINT_PATH = os.getenv("BLAP_CHECKPOINT_PATH", "checkpoint.ckpt")
+MODEL_CONFIG_PATH = os.getenv("BLAP_MODEL_CONFIG_PATH", "config.json")
+WARMUP_SECONDS = float(os.getenv("CAPTION_WARMUP_SECONDS", "1"))
+MAX_BATCH_SIZE = int(os.getenv("CAPTION_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.getenv("CAPTION_MAX_WAIT_MS", "20"))
+MAX_QUEUE = int(os.getenv("CAPTION_MAX_QUEUE", "256"))
+# Long-track mode: window length (the clip length the model was trained on) and the cap per track
+CAPTION_WINDOW_SECONDS = float(os.getenv("CAPTION_WINDOW_SECONDS", "10"))
+CAPTION_MAX_SEGMENTS = int(os.getenv("CAPTION_MAX_SEGMENTS", "64"))
+# "module:function" building the model instead of BLAP2 (e.g. the benchmark stand-in)
+MODEL_FACTORY = os.getenv("CAPTION_MODEL_FACTORY", "")
+# Model converted by convert_weights.py; memory-mapped instead of loading the checkpoint
+WEIGHTS_PATH = os.getenv("CAPTION_WEIGHTS_PATH", "")
+# Inference profiles (see inference_profiles.py): the deployment default and the ones requests may pick.
+# Every enabled profile that quantises or compiles keeps its own copy of the weights.
+PROFILES = load_profiles(os.getenv("CAPTION_PROFILES_JSON", ""))
+DEFAULT_PROFILE = os.getenv("CAPTION_PROFILE", "quality")
+ENABLED_PROFILES = enabled_profile_names(os.getenv("CAPTION_ENABLED_PROFILES", ""), DEFAULT_PROFILE, PROFILES)
+# Attribute path of the audio encoder inside the model, the part compiled by "compile" profiles
+ENCODER_MODULE = os.getenv("CAPTION_ENCODER_MODULE", "audio_encoder")
+# 0 keeps torch's default of one thread per core
+TORCH_THREADS = int(os.getenv("CAPTION_TORCH_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("CAPTION_TORCH_INTEROP_THREADS", "0"))
+
+model_manager = ModelManager(CHECKPOINT_PATH, MODEL_CONFIG_PATH, WARMUP_SECONDS,
+                             resolve_model_factory(MODEL_FACTORY, WEIGHTS_PATH),
+                             [PROFILES[name] for name in ENABLED_PROFILES], ENCODER_MODULE)
+scheduler = BatchScheduler(model_manager, MAX_BATCH_SIZE, MAX_WAIT_MS, MAX_QUEUE)
+result_cache = ResultCache.from_env()
+
+async def load_model():
+    try:
+        await asyncio.to_thread(model_manager.warm_up)
+    except Exception:
+        pass  # state/error are kept on the manager and reported by /ready
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Here rather than at import: serve.py imports this module in the parent, which must stay
+    # single-threaded until it forks (OpenMP thread pools do not survive fork)
+    configure_threads(TORCH_THREADS, TORCH_INTEROP_THREADS)
+    # Load in the background so the process answers /ready while the weights load
+    load_task = asyncio.create_task(load_model())
+    await scheduler.start()
+    yield
+    await scheduler.stop()
+    load_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app, "music-caption")
 print("Platform architecture:", platform.machine())
 print("Torch version:", torch.__version__)
+
+@app.get("/ready")
+async def ready():
+    status = model_manager.status()
+    return JSONResponse(content=status, status_code=200 if model_manager.ready else 503)
+
+async def caption_samples(samples: torch.Tensor, profile: InferenceProfile) -> str:
+    # Batched with concurrent requests (and with the other windows of the same track)
+    return await scheduler.submit(samples, CAPTION_PROMPT, profile)
+
+async def caption_file(upload: UploadFile, mode: str, window_seconds: float, hop_seconds: float,
+                       profile: InferenceProfile) -> dict:
+    contents = await upload.read()
+    window_params = {"window_seconds": window_seconds, "hop_seconds": hop_seconds} if mode == "segments" else {}
+    cache_key = make_cache_key(hash_bytes(contents), prompt=CAPTION_PROMPT, checkpoint=WEIGHTS_PATH or CHECKPOINT_PATH,
+                               mode=mode, sample_rate=MODEL_SAMPLE_RATE, **profile.settings(), **window_params)
+    cached = await result_cache.get_async(cache_key)
+    if cached is not None:
+        return {"filename": upload.filename, **json.loads(cached)}
+    with Stopwatch("Decode", stage="decode"):
+        try:
+            samples = await asyncio.to_thread(decode_audio, contents)
+        except sf.LibsndfileError as e:
+            raise HTTPException(status_code=400, detail=f"Could not decode {upload.filename}: {e}")
+    result = {"duration_seconds": samples.shape[-1] / MODEL_SAMPLE_RATE}
+    with Stopwatch("Caption"):
+        try:
+            if mode == "segments":
+                segments = split_windows(samples, window_seconds, hop_seconds)
+                if len(segments) > CAPTION_MAX_SEGMENTS:
+                    raise HTTPException(status_code=400, detail=f"{upload.filename} needs {len(segments)} windows, "
+                                                                f"more than {CAPTION_MAX_SEGMENTS}; use a larger hop_seconds")
+                captions = await asyncio.gather(*[caption_samples(segment.audio, profile) for segment in segments])
+                result["segments"] = [
+                    {"start_seconds": segment.start_seconds, "end_seconds": segment.end_seconds, "caption": caption}
+                    for segment, caption in zip(segments, captions)
+                ]
+            else:
+                result["caption"] = await caption_samples(samples, profile)
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error during prediction: {e}")
+            raise HTTPException(status_code=500, detail="Error during prediction")
+    print(f"Generated caption for {upload.filename}:", result.get("caption") or result["segments"])
+    await result_cache.put_async(cache_key, json.dumps(result).encode("utf-8"))
+    return {"filename": upload.filename, **result}
+
+@app.get("/profiles")
+async def profiles():
+    return {
+        "default": DEFAULT_PROFILE,
+        "profiles": {name: PROFILES[name].settings() for name in ENABLED_PROFILES},
+    }
+
 @app.post("/music-caption")
 async def music_caption(
     prompt: str = Form(...),         # Text field
-    audios: List[UploadFile] = File(...)         # music file
+    audios: List[UploadFile] = File(...),         # music files
+    mode: str = "clip",
+    window_seconds: float = CAPTION_WINDOW_SECONDS,
+    hop_seconds: Optional[float] = None,
+    profile: Optional[str] = None,
 ):
-    print("step1")
-    class Stopwatch:
-        def __enter__(self):
-            self.start = time.perf_counter()
-            return self
-        def __exit__(self, *args):
-            self.end = time.perf_counter()
-            self.elapsed = self.end - self.start
-            print(f"Elapsed time: {self.elapsed:.3f} seconds")
-
+    """Caption every uploaded file.
 
-    ckpt_path = "checkpoint.ckpt"
-    modelConfig_path = "config.json"
-    print("step1")
-    with Stopwatch():
-        blap_model = BLAP2_Stage2.from_checkpoint(
-            checkpoint_path=ckpt_path,
-            modelConfig=modelConfig_path,
-        )
-        # Create captions
-        # Set the model to evaluation mode
-        print("step1-A")
-        blap_model = blap_model.eval()
-    print("step2")
-    # Prepare your audio data (example here is a numpy array)
-    # Ensure the audio is in shape (samples, 4800000) with a sampling rate of 48 kHz
-    with Stopwatch():
-        audio_data, sample_rate = sf.read(audios[0].file)
+    mode=clip captions each file as a whole. mode=segments cuts each track into
+    window_seconds windows every hop_seconds (default: no overlap), captions them as one
+    batch and returns time-stamped segment captions. A single file in clip mode returns
+    the bare caption string as before; otherwise {"results": [...]} in upload order.
+    profile picks one of the enabled inference profiles (GET /profiles) instead of the default.
+    """
+    if not model_manager.ready:
+        raise HTTPException(status_code=503, detail=f"Model is not ready (state: {model_manager.state})")
+    if mode not in ("clip", "segments"):
+        raise HTTPException(status_code=400, detail="mode must be 'clip' or 'segments'")
+    profile_name = profile or DEFAULT_PROFILE
+    if profile_name not in ENABLED_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown or disabled profile {profile_name!r}; "
+                                                    f"enabled: {', '.join(ENABLED_PROFILES)}")
+    hop_seconds = hop_seconds or window_seconds
+    if window_seconds <= 0 or hop_seconds <= 0:
+        raise HTTPException(status_code=400, detail="window_seconds and hop_seconds must be positive")
+    results = await asyncio.gather(*[caption_file(audio, mode, window_seconds, hop_seconds, PROFILES[profile_name])
+                                   for audio in audios])
+    if mode == "clip" and len(results) == 1:
+        return results[0]["caption"]
+    return {"results": results}
 
-    # Convert the audio data to a tensor and reshape it to the correct input shape
-        audio_tensor = torch.tensor(audio_data).reshape(1, -1).float() 
-    print("step3")
-    with Stopwatch():
-    # Generate the caption for the audio data
-        with torch.no_grad():
-            try:
-                output = blap_model.predict_answers(
-                    audio_tensor,
-                    "Provide a music caption for this audio clip. Do not mention audio quality",
-                    max_len=40,
-                    min_len=30,
-                    num_beams=10
-                )
-            except Exception as e:
-                print(f"Error during prediction: {e}")
-                raise HTTPException(status_code=500, detail="Error during prediction")
-    print("step4")
-    # Print the generated caption
-    print("Generated Caption:", output[0])
-    return output[0]
\ No newline at end of file
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
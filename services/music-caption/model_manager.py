@@ -0,0 +1,222 @@
+import contextlib
+import copy
+import importlib
+import os
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../externals/blap")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../shared")))
+from instrumentation import observe_stage
+from inference_profiles import InferenceProfile
+
+CAPTION_PROMPT = "Provide a music caption for this audio clip. Do not mention audio quality"
+MODEL_SAMPLE_RATE = 48000
+
+class Stopwatch:
+    """Prints how long a block took and, given a stage name, records it in the stage metrics."""
+    def __init__(self, label: str = "Elapsed time", stage: str = None):
+        self.label = label
+        self.stage = stage
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        self.end = time.perf_counter()
+        self.elapsed = self.end - self.start
+        print(f"{self.label}: {self.elapsed:.3f} seconds")
+        if self.stage:
+            observe_stage(self.stage, self.elapsed)
+
+def load_blap_model(checkpoint_path: str, model_config_path: str):
+    from blap.model.BLAP2.BLAP2_Pretrain import BLAP2_Stage2
+    return BLAP2_Stage2.from_checkpoint(checkpoint_path=checkpoint_path, modelConfig=model_config_path)
+
+def load_mmap_model(weights_path: str):
+    """Load a model saved by convert_weights.py with its tensors memory-mapped from the file.
+
+    The pages come from the OS page cache, so every process on the node that loads the
+    same file shares one copy of the weights, and loading takes no time proportional to
+    the model size. The file is a pickle: only load files you converted yourself.
+    """
+    return torch.load(weights_path, map_location="cpu", mmap=True, weights_only=False)
+
+def resolve_model_factory(spec: str, weights_path: str = "") -> Callable:
+    """Turn "package.module:function" into that function; an empty spec means the BLAP2 loader,
+    or the memory-mapped converted model when weights_path is set."""
+    if weights_path:
+        return lambda checkpoint_path, model_config_path: load_mmap_model(weights_path)
+    if not spec:
+        return load_blap_model
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+def configure_threads(intra_op: int = 0, inter_op: int = 0):
+    """Size torch's thread pools; 0 keeps torch's default (one thread per core)."""
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        # Only possible before the first parallel op, i.e. at startup
+        torch.set_num_interop_threads(inter_op)
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def compile_submodule(model: torch.nn.Module, module_path: str, backend: str,
+                      check: Optional[Callable[[torch.nn.Module], object]] = None):
+    """Replace model.<module_path> by its torch.compile / TorchScript version; eager on failure.
+
+    torch.compile only traces on the first call, so its errors surface there: check(model)
+    runs that call, and the eager module is put back when it raises.
+    """
+    parent_path, _, name = module_path.rpartition(".")
+    try:
+        parent = model.get_submodule(parent_path) if parent_path else model
+        module = getattr(parent, name)
+    except AttributeError as e:
+        print(f"Could not compile {module_path} with {backend}, keeping it eager: {e}")
+        return
+    try:
+        if backend == "torchscript":
+            compiled = torch.jit.script(module)
+        else:
+            # Clip length and batch size vary, do not recompile for every shape
+            compiled = torch.compile(module, dynamic=True)
+        setattr(parent, name, compiled)
+        if check is not None:
+            check(model)
+    except Exception as e:
+        setattr(parent, name, module)
+        print(f"Could not compile {module_path} with {backend}, keeping it eager: {e}")
+
+class ModelManager:
+    """Loads the BLAP2 model once and shares it (read-only) across requests.
+
+    model_factory(checkpoint_path, model_config_path) builds the model; it defaults to
+    the BLAP2 loader and can be swapped for a stand-in (see benchmarks/blap_standin.py).
+    Each enabled inference profile gets its model variant (quantised and/or compiled copy)
+    built and warmed up at startup; profiles needing the same variant share it.
+    """
+    def __init__(self, checkpoint_path: str, model_config_path: str, warmup_seconds: float = 1.0,
+                 model_factory: Optional[Callable] = None, profiles: Optional[List[InferenceProfile]] = None,
+                 encoder_module: str = "audio_encoder"):
+        self.model_factory = model_factory or load_blap_model
+        self.checkpoint_path = checkpoint_path
+        self.model_config_path = model_config_path
+        self.warmup_seconds = warmup_seconds
+        self.profiles = {profile.name: profile for profile in profiles or [InferenceProfile("quality")]}
+        self.encoder_module = encoder_module
+        self.bf16_supported = cpu_supports_bf16()
+        self.variants = {}
+        self.model = None
+        self.state = "not_loaded"
+        self.error = None
+        self.load_time = None
+        self.warmup_time = None
+        # Reset by serve.py in each forked worker, so startup_time is that worker's own start-up
+        self.startup_began = time.perf_counter()
+        self.startup_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def load(self):
+        with self._lock:
+            if self.model is not None:
+                return self.model
+            self.state = "loading"
+            try:
+                with Stopwatch("Model load", stage="model_load") as sw:
+                    model = self.model_factory(self.checkpoint_path, self.model_config_path)
+                    model = model.eval()
+                    # Weights are shared by every request, nobody may train them
+                    for param in model.parameters():
+                        param.requires_grad_(False)
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                print(f"Failed to load model: {e}")
+                raise
+            self.model = model
+            self.load_time = sw.elapsed
+            self.state = "loaded"
+            return model
+
+    def prepare(self, profile: InferenceProfile):
+        """Build the model variant a profile runs on (a no-op for the plain fp32 model)."""
+        model = self.load()
+        if not profile.quantize and not profile.compile:
+            return model
+        with self._lock:
+            if profile.variant in self.variants:
+                return self.variants[profile.variant]
+            with Stopwatch(f"Model variant for {profile.name}", stage="model_prepare"):
+                if profile.quantize:
+                    variant = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                else:
+                    variant = copy.deepcopy(model)
+                if profile.compile:
+                    # Even with warm-up disabled, one short call has to run the compiler now
+                    seconds = max(self.warmup_seconds, 0.1)
+                    compile_submodule(variant, self.encoder_module, profile.compile,
+                                      check=lambda compiled: self.dummy_inference(compiled, profile, seconds))
+            self.variants[profile.variant] = variant
+            return variant
+
+    def autocast(self, profile: InferenceProfile):
+        if profile.bf16 and self.bf16_supported:
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def dummy_inference(self, model, profile: InferenceProfile, seconds: float):
+        dummy = torch.zeros(1, int(seconds * MODEL_SAMPLE_RATE))
+        with torch.no_grad(), self.autocast(profile):
+            model.predict_answers(dummy, CAPTION_PROMPT, max_len=5, min_len=1, num_beams=profile.num_beams)
+
+    def warm_up(self):
+        """Build every profile's variant and run one dummy inference through it, so the first
+        real request pays neither for lazy init nor for compilation."""
+        self.load()
+        self.state = "warming_up"
+        with Stopwatch("Model warm-up", stage="warmup") as sw:
+            for profile in self.profiles.values():
+                if profile.bf16 and not self.bf16_supported:
+                    print(f"Profile {profile.name}: this CPU has no native bfloat16, running it in float32")
+                try:
+                    model = self.prepare(profile)
+                    if self.warmup_seconds > 0:
+                        self.dummy_inference(model, profile, self.warmup_seconds)
+                except Exception as e:
+                    # A failed warm-up is not fatal, the model itself is loaded
+                    print(f"Model warm-up failed for profile {profile.name}: {e}")
+        self.warmup_time = sw.elapsed
+        self.startup_time = time.perf_counter() - self.startup_began
+        observe_stage("startup", self.startup_time)
+        self.state = "ready"
+
+    def get(self, profile: Optional[InferenceProfile] = None):
+        if not self.ready:
+            raise RuntimeError(f"Model is not ready (state: {self.state})")
+        if profile is None or (not profile.quantize and not profile.compile):
+            return self.model
+        return self.prepare(profile)
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "load_seconds": self.load_time,
+            "warmup_seconds": self.warmup_time,
+            "startup_seconds": self.startup_time,
+            "pid": os.getpid(),
+            "profiles": list(self.profiles),
+            "bf16_supported": self.bf16_supported,
+        }
@@ -0,0 +1,126 @@
+"""Pre-fork serving: load the model once, then fork workers that share it copy-on-write.
+
+    python serve.py --workers 4 --host 0.0.0.0 --port 8000
+
+The parent imports the app (torch, FastAPI, ...), loads the weights and builds the model
+variants of the enabled profiles, then forks the workers. They inherit all of that, so
+the weights are in RAM once however many workers run, and a worker only pays for its
+warm-up (see startup_seconds in /ready and the "startup" stage metric). Dead workers are
+restarted from the same parent. With CAPTION_WEIGHTS_PATH the weights are additionally
+memory-mapped, so even separate deployments on one node share them.
+
+The parent does its torch work on a single thread: GNU OpenMP is not fork-safe, and a child
+forked after the parent ran a multi-threaded op can deadlock on its first parallel op. Each
+worker sizes its own thread pools after the fork. If the parent cannot load the model it
+exits instead of leaving every worker to load its own copy.
+
+Each worker has its own batch scheduler, result memory cache and /metrics registry.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+from model_manager import Stopwatch
+
+RESTART_BACKOFF_SECONDS = 1.0
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(sock: socket.socket, args, threads_per_worker: int):
+    import uvicorn
+    import main
+    main.model_manager.startup_began = time.perf_counter()
+    if threads_per_worker > 0:
+        # main's lifespan applies CAPTION_TORCH_THREADS / _INTEROP_THREADS; this is the default split
+        main.TORCH_THREADS = threads_per_worker
+    config = uvicorn.Config(main.app, log_level=args.log_level, timeout_keep_alive=args.timeout_keep_alive)
+    uvicorn.Server(config).run(sockets=[sock])
+
+def main_loop():
+    parser = argparse.ArgumentParser(description="Serve music-caption from pre-forked workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CAPTION_WORKERS", "2")))
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--timeout-keep-alive", type=int, default=5)
+    args = parser.parse_args()
+
+    with Stopwatch("Imports"):
+        import torch
+        import main
+    # No intra-op pool in the parent, and no inter-op pool either (nothing here launches one)
+    torch.set_num_threads(1)
+    manager = main.model_manager
+    try:
+        with Stopwatch("Model load and variants"):
+            for profile in manager.profiles.values():
+                manager.prepare(profile)
+    except Exception as e:
+        print(f"Could not load the model before forking: {e}", file=sys.stderr)
+        sys.exit(1)
+    # Without this the collector's writes to object headers would copy every page in every worker
+    gc.freeze()
+    # Split the cores between the workers unless the deployment sized the pools itself
+    threads_per_worker = 0 if main.TORCH_THREADS else max(1, (os.cpu_count() or 1) // max(1, args.workers))
+
+    sock = bind_socket(args.host, args.port)
+    workers = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(sock, args, threads_per_worker)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = time.monotonic()
+        print(f"Started worker {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(max(1, args.workers)):
+        spawn()
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f"Worker {pid} exited ({os.waitstatus_to_exitcode(status)}), restarting", file=sys.stderr)
+        # Do not spin when workers die right after start
+        if time.monotonic() - started < RESTART_BACKOFF_SECONDS:
+            time.sleep(RESTART_BACKOFF_SECONDS)
+        spawn()
+
+if __name__ == "__main__":
+    main_loop()
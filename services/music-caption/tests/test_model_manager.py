@@ -0,0 +1,34 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip("torch")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+from benchmarks.blap_standin import StandInCaptioner
+from inference_profiles import InferenceProfile
+from model_manager import ModelManager, compile_submodule
+
+def failing_backend(graph_module, example_inputs):
+    raise RuntimeError("backend exploded")
+
+@pytest.fixture
+def broken_compile(monkeypatch):
+    # Like a broken Inductor install: wrapping succeeds, the first call fails
+    real_compile = torch.compile
+    monkeypatch.setattr(torch, "compile", lambda module, **kwargs: real_compile(module, backend=failing_backend, **kwargs))
+
+def test_compile_failure_on_first_call_keeps_eager_module(broken_compile):
+    model = StandInCaptioner()
+    eager = model.audio_encoder
+    compile_submodule(model, "audio_encoder", "inductor",
+                      check=lambda compiled: compiled.predict_answers(torch.zeros(1, 4096), "prompt"))
+    assert model.audio_encoder is eager
+
+def test_fast_profile_serves_after_compile_failure(broken_compile):
+    profile = InferenceProfile("fast", num_beams=1, max_len=30, min_len=10, compile="inductor")
+    manager = ModelManager("", "", warmup_seconds=0, model_factory=lambda *paths: StandInCaptioner(),
+                           profiles=[profile])
+    manager.warm_up()
+    model = manager.get(profile)
+    assert type(model.audio_encoder) is torch.nn.Sequential
+    assert len(model.predict_answers(torch.zeros(1, 4096), "prompt", num_beams=1)) == 1
@@ -1,13 +1,24 @@
 import os
-import sqlite3
+import sys
+import asyncio
+import hashlib
+import shutil
+import time
 import fsspec
 from datetime import datetime
-from typing import Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from typing import Optional, Dict, Any, List, Tuple
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import json
 import pathlib
+import re
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../shared")))
+from instrumentation import instrument_app, stage, observe_stage, count_storage_bytes
+from metadata_store import MetadataStore, make_history_file_path
+from storage_cache import TTLCache
 class MetadataModel(BaseModel):
     description: str
     evaluation: str
@@ -17,6 +28,84 @@ class MetadataUpdate(BaseModel):
     file_path: str
     parameter_name: str
     value: str
+
+class MetadataBatchGet(BaseModel):
+    file_paths: List[str]
+    version: Optional[int] = None
+
+# Transfer size for streamed uploads/downloads
+CHUNK_SIZE = int(os.getenv('STORAGE_CHUNK_SIZE', str(1024 * 1024)))
+
+METADATA_COLUMNS = 'file_path, description, evaluation, additional_info, created_at, updated_at, content_hash'
+METADATA_QUERY_CHUNK = 500
+# Upper bounds for one listing page / batch lookup
+LIST_PAGE_MAX = int(os.getenv('LIST_PAGE_MAX', '1000'))
+METADATA_BATCH_MAX = int(os.getenv('METADATA_BATCH_MAX', '1000'))
+
+SEARCH_PAGE_MAX = int(os.getenv('SEARCH_PAGE_MAX', '200'))
+# bm25 column weights: file_path, description, evaluation, additional_info
+SEARCH_WEIGHTS = (0.5, 2.0, 1.0, 1.0)
+SEARCH_TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def build_fts_query(text: str, prefix: bool) -> str:
+    """Turn free text into an FTS5 query: every word must match, quoted so operators are literal."""
+    terms = SEARCH_TOKEN_PATTERN.findall(text)
+    return ' '.join(f'"{term}"*' if prefix else f'"{term}"' for term in terms)
+
+def path_prefix_range(path_prefix: str) -> Tuple[str, str]:
+    # Half-open range on the file_path index instead of a LIKE scan
+    return path_prefix, path_prefix + '\U0010ffff'
+
+# Default lifetime of cached exists/isfile/info/ls results; local disk is fast enough uncached
+PATH_CACHE_TTL_DEFAULTS = {'file': 0.0, 's3': 30.0, 'gcs': 30.0}
+
+def path_cache_key(full_path: str) -> str:
+    """'s3://bucket/dir/' and 's3://bucket/dir' are one cache entry; roots ('/', 's3://') stay as they are."""
+    stripped = full_path.rstrip('/')
+    if not stripped or stripped.endswith(':'):
+        return full_path
+    return stripped
+
+def parent_path_keys(full_path: str) -> List[str]:
+    """Cache keys of every parent directory, keeping the protocol prefix of URLs.
+
+    PurePosixPath would turn 's3://bucket/dir/x' into 's3:/bucket/dir', which never matches.
+    """
+    protocol, separator, rest = full_path.partition('://')
+    if not separator:
+        protocol, rest = '', full_path
+    prefix = protocol + separator
+    parts = path_cache_key(rest).split('/')
+    return [prefix + ('/'.join(parts[:end]) or '/') for end in range(len(parts) - 1, 0, -1)]
+
+def existing_device(path: str) -> int:
+    """st_dev of the path, or of its nearest existing parent when it is not created yet."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+def metadata_row_to_dict(row) -> dict:
+    return {
+        'file_path': row[0],
+        'description': row[1],
+        'evaluation': row[2],
+        'additional_info': row[3],
+        'created_at': row[4],
+        'updated_at': row[5],
+        'content_hash': row[6]
+    }
+
+def hash_stream(source) -> str:
+    """SHA-256 of a file object read in chunks."""
+    digest = hashlib.sha256()
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    return digest.hexdigest()
+
 # Configuration from environment variables
 class StorageHelper:
     def __init__(self, storage_config_json: str):
@@ -36,28 +125,26 @@ class StorageHelper:
                                                     token=self.storage_config.get('gcpServiceAccountKey'))
         else:
             raise ValueError(f"Unsupported storage type: {self.storage_type}")
-        self.database_path = self.get_absolute_path("metadata.db")
-        self.init_database()
+        # SQLite needs a local file; remote backends must point database_path at one
+        self.database_path = self.storage_config.get('database_path') or self.get_absolute_path("metadata.db")
+        self.metadata_store = MetadataStore(self.database_path, readers=int(self.storage_config.get('database_readers', 4)))
+        # Store versions as SHA-256 keyed blobs shared between identical files (history storage)
+        self.content_addressed = bool(self.storage_config.get('content_addressed', False))
+        # Read-through caches, invalidated by this service's own writes; the TTL bounds
+        # staleness from writers outside it (other processes, direct bucket edits)
+        self.path_cache = TTLCache(
+            max_entries=int(self.storage_config.get('cache_max_entries', 10000)),
+            ttl=float(self.storage_config.get('cache_ttl_seconds', PATH_CACHE_TTL_DEFAULTS[self.storage_type])))
+        self.metadata_cache = TTLCache(
+            max_entries=int(self.storage_config.get('metadata_cache_max_entries', 10000)),
+            ttl=float(self.storage_config.get('metadata_cache_ttl_seconds', 5.0)))
     def get_absolute_path(self, relative_path: str):
         return self.absolute_root + "/" + relative_path
-    def init_database(self):
-        """Initialize SQLite database"""
-        print(f"Initializing database at {self.database_path}")
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS file_metadata (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path TEXT UNIQUE NOT NULL,
-                description TEXT NOT NULL,
-                evaluation TEXT NOT NULL,
-                additional_info TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    async def open(self):
+        """Open the metadata database connections"""
+        await self.metadata_store.open()
+    async def close(self):
+        await self.metadata_store.close()
     def ensure_parent_directories(self, full_file_path: str):
         parent_dir = pathlib.PurePosixPath(full_file_path).parent
         if parent_dir:
@@ -67,159 +154,515 @@ class StorageHelper:
                 if self.file_system.protocol in ["file", "local"]:
                     raise RuntimeError(f"Failed to create directory: {e}")
                 # Otherwise, it's a virtual FS; skip
+    def _cached(self, kind: str, full_path: str, fetch):
+        key = (kind, path_cache_key(full_path))
+        hit, value = self.path_cache.get(key)
+        if hit:
+            return value
+        token = self.path_cache.token()
+        value = fetch(full_path)
+        self.path_cache.put(key, value, token)
+        return value
+    def exists(self, full_path: str) -> bool:
+        return self._cached('exists', full_path, self.file_system.exists)
+    def ls_detail(self, full_path: str) -> List[Dict[str, Any]]:
+        return self._cached('ls', full_path, lambda path: self.file_system.ls(path, detail=True))
+    def invalidate_path(self, full_path: str):
+        """Forget cached state of a path that was written, moved or removed, and of its parents' listings."""
+        path_key = path_cache_key(full_path)
+        keys = [('exists', path_key), ('info', path_key), ('ls', path_key)]
+        keys += [('ls', parent) for parent in parent_path_keys(full_path)]
+        self.path_cache.invalidate(*keys)
+    def cache_stats(self) -> Dict[str, Any]:
+        return {'paths': self.path_cache.stats(), 'metadata': self.metadata_cache.stats()}
+    @contextmanager
+    def open_for_replace(self, full_path: str):
+        """Open full_path for writing without truncating the existing file in place.
+
+        A local file may share its inode with a history hard link, so it is written under a
+        temporary name and renamed over the old one; object stores replace objects anyway.
+        """
+        if self.storage_type != 'file':
+            with self.file_system.open(full_path, 'wb') as f:
+                yield f
+            return
+        temp_path = f"{full_path}.{uuid.uuid4().hex}.partial"
+        try:
+            with self.file_system.open(temp_path, 'wb') as f:
+                yield f
+            self.file_system.mv(temp_path, full_path)
+        except BaseException:
+            try:
+                self.file_system.rm(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
     def write_file_to_storage(self, file_path: str, content: bytes):
         full_path = self.get_absolute_path(file_path)
         self.ensure_parent_directories(full_path)
-        with self.file_system.open(full_path, 'wb') as f:
-            f.write(content)
-    def get_file_metadata(self, file_path: str):
+        try:
+            with self.open_for_replace(full_path) as f:
+                f.write(content)
+        finally:
+            self.invalidate_path(full_path)
+    def write_stream_to_storage(self, file_path: str, source) -> int:
+        """Copy a file object into storage chunk by chunk; returns the number of bytes written."""
+        full_path = self.get_absolute_path(file_path)
+        self.ensure_parent_directories(full_path)
+        written = 0
+        try:
+            with stage("storage_write", target=self.storage_type):
+                with self.open_for_replace(full_path) as f:
+                    while True:
+                        chunk = source.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        written += len(chunk)
+        finally:
+            self.invalidate_path(full_path)
+            count_storage_bytes('write', written)
+        return written
+    def blob_full_path(self, content_hash: str) -> str:
+        return self.get_absolute_path(f"blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}")
+    def hash_file(self, full_path: str) -> str:
+        with self.file_system.open(full_path, 'rb') as f:
+            return hash_stream(f)
+    def same_backend(self, other: 'StorageHelper') -> bool:
+        """True when native copy/rename can move files between the two helpers."""
+        if self.storage_type != other.storage_type:
+            return False
+        if self.storage_type == 'file':
+            # Hard links and renames only work within one volume (else EXDEV)
+            return existing_device(self.absolute_root) == existing_device(other.absolute_root)
+        credential_keys = ('awsAccessKeyId', 'awsSecretAccessKey', 'gcpServiceAccountKey')
+        return all(self.storage_config.get(key) == other.storage_config.get(key) for key in credential_keys)
+    def get_file_info(self, full_path: str) -> Dict[str, Any]:
+        return self._cached('info', full_path, self._file_info)
+    def _file_info(self, full_path: str) -> Dict[str, Any]:
+        """Size and a strong validator (backend ETag/hash, else size + mtime) for HTTP caching."""
+        info = self.file_system.info(full_path)
+        size = info.get('size') or 0
+        etag = info.get('ETag') or info.get('etag') or info.get('md5Hash')
+        if not etag:
+            modified = info.get('mtime') or info.get('LastModified') or info.get('updated') or ''
+            if isinstance(modified, datetime):
+                modified = modified.timestamp()
+            etag = f"{size:x}-{modified}"
+        etag = etag if etag.startswith('"') else f'"{etag}"'
+        return {'size': size, 'etag': etag}
+    def iter_file(self, full_path: str, start: int = 0, length: Optional[int] = None):
+        """Yield a byte range of a stored file in CHUNK_SIZE pieces."""
+        # Only time spent reading counts, not time the client takes to consume each chunk
+        read_seconds = 0.0
+        read_bytes = 0
+        try:
+            with self.file_system.open(full_path, 'rb') as f:
+                f.seek(start)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    started = time.perf_counter()
+                    chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                    read_seconds += time.perf_counter() - started
+                    if not chunk:
+                        break
+                    read_bytes += len(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+        finally:
+            observe_stage("storage_read", read_seconds, target=self.storage_type)
+            count_storage_bytes('read', read_bytes)
+    async def get_file_metadata(self, file_path: str):
         """Get file metadata from database"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT file_path, description, evaluation, additional_info, created_at, updated_at
+        hit, cached = self.metadata_cache.get(file_path)
+        if hit:
+            return cached
+        token = self.metadata_cache.token()
+        metadata = await self._fetch_file_metadata(file_path)
+        self.metadata_cache.put(file_path, metadata, token)
+        return metadata
+    async def _fetch_file_metadata(self, file_path: str):
+        result = await self.metadata_store.fetchone(f'''
+            SELECT {METADATA_COLUMNS}
             FROM file_metadata 
             WHERE file_path = ?
         ''', (file_path,))
         
-        result = cursor.fetchone()
-        conn.close()
-        
         if result:
             #additional_info = json.loads(result[3]) if result[3] else {}
-            return {
-                'file_path': result[0],
-                'description': result[1],
-                'evaluation': result[2],
-                'additional_info': result[3],
-                'created_at': result[4],
-                'updated_at': result[5]
-            }
+            return metadata_row_to_dict(result)
         return None
-    def save_file_metadata(self, file_path: str, metadata: MetadataModel):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    async def get_files_metadata(self, file_paths: List[str]) -> Dict[str, dict]:
+        """Metadata rows for many files, keyed by file_path; files without a row are absent."""
+        found = {}
+        unique_paths = []
+        for file_path in dict.fromkeys(file_paths):
+            hit, cached = self.metadata_cache.get(file_path)
+            if not hit:
+                unique_paths.append(file_path)
+            elif cached is not None:
+                found[file_path] = cached
+        token = self.metadata_cache.token()
+        # Stay below SQLite's bound-parameter limit
+        for i in range(0, len(unique_paths), METADATA_QUERY_CHUNK):
+            chunk = unique_paths[i:i + METADATA_QUERY_CHUNK]
+            rows = await self.metadata_store.fetchall(f'''
+                SELECT {METADATA_COLUMNS}
+                FROM file_metadata
+                WHERE file_path IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+            for row in rows:
+                found[row[0]] = metadata_row_to_dict(row)
+        for file_path in unique_paths:
+            self.metadata_cache.put(file_path, found.get(file_path), token)
+        return found
+    async def save_file_metadata(self, file_path: str, metadata: MetadataModel,
+                                 source_path: Optional[str] = None, version: Optional[int] = None,
+                                 content_hash: Optional[str] = None, stored_as_blob: bool = False, conn=None):
+        """Insert or replace a metadata row; pass conn to join an open transaction."""
         #additional_info_json = json.dumps(metadata.additional_info) if metadata.additional_info else '{}'
-        cursor.execute('''
+        sql = '''
             INSERT OR REPLACE INTO file_metadata 
-            (file_path, description, evaluation, additional_info, updated_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (file_path, metadata.description, metadata.evaluation, metadata.additional_info))
-        conn.commit()
-        conn.close()
-    def update_metadata_parameter(self, file_path: str, parameter_name: str, value: str):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+            (file_path, description, evaluation, additional_info, source_path, version, content_hash, stored_as_blob, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        '''
+        params = (file_path, metadata.description, metadata.evaluation, metadata.additional_info,
+                  source_path, version, content_hash, int(stored_as_blob))
+        if conn is not None:
+            await conn.execute(sql, params)
+            self.metadata_store.after_commit(lambda: self.metadata_cache.invalidate(file_path))
+        else:
+            await self.metadata_store.execute(sql, params)
+            self.metadata_cache.invalidate(file_path)
+    async def search_metadata(self, query: str, path_prefix: Optional[str], limit: int, offset: int) -> List[dict]:
+        """Ranked full-text search over metadata rows, best match first."""
+        sql = f'''
+            SELECT {", ".join(f"m.{column.strip()}" for column in METADATA_COLUMNS.split(","))},
+                   bm25(file_metadata_fts, {", ".join(map(str, SEARCH_WEIGHTS))}) AS score,
+                   snippet(file_metadata_fts, -1, '[', ']', '...', 12)
+            FROM file_metadata_fts
+            JOIN file_metadata m ON m.id = file_metadata_fts.rowid
+            WHERE file_metadata_fts MATCH ?
+        '''
+        params: List[Any] = [query]
+        if path_prefix:
+            sql += ' AND m.file_path >= ? AND m.file_path < ?'
+            params.extend(path_prefix_range(path_prefix))
+        sql += ' ORDER BY score LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+        rows = await self.metadata_store.fetchall(sql, params)
+        results = []
+        for row in rows:
+            item = metadata_row_to_dict(row)
+            # bm25 is lower-is-better; flip it so larger scores rank higher for clients
+            item['score'] = -row[-2]
+            item['snippet'] = row[-1]
+            results.append(item)
+        return results
+    async def update_metadata_parameter(self, file_path: str, parameter_name: str, value: str):
         print(f"Updating {parameter_name} for {file_path} to {value}")
-        # Get current metadata
-        cursor.execute('''
-            SELECT description, evaluation, additional_info
-            FROM file_metadata 
-            WHERE file_path = ?
-        ''', (file_path,))
-        print(f"Executing query for {file_path}")
-        result = cursor.fetchone()
-        print(f"Query result: {result}")
-        if not result:
-            conn.close()
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        description, evaluation, additional_info = result
-        
-        # Update the parameter
-        if parameter_name == 'description':
-            description = value
-        elif parameter_name == 'evaluation':
-            evaluation = value
-        elif parameter_name == 'additional_info':
-            additional_info = value
-        
-        # Save updated metadata
-        cursor.execute('''
-            UPDATE file_metadata 
-            SET description = ?, evaluation = ?, additional_info = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE file_path = ? 
-        ''', (description, evaluation, additional_info, file_path))
-        
-        conn.commit()
-        conn.close()
+        # Read and write in one transaction so concurrent updates cannot interleave
+        async with self.metadata_store.transaction() as conn:
+            # Get current metadata
+            async with conn.execute('''
+                SELECT description, evaluation, additional_info
+                FROM file_metadata 
+                WHERE file_path = ?
+            ''', (file_path,)) as cursor:
+                result = await cursor.fetchone()
+            if not result:
+                raise HTTPException(status_code=404, detail="File not found")
+            
+            description, evaluation, additional_info = result
+            
+            # Update the parameter
+            if parameter_name == 'description':
+                description = value
+            elif parameter_name == 'evaluation':
+                evaluation = value
+            elif parameter_name == 'additional_info':
+                additional_info = value
+            
+            # Save updated metadata
+            await conn.execute('''
+                UPDATE file_metadata 
+                SET description = ?, evaluation = ?, additional_info = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE file_path = ? 
+            ''', (description, evaluation, additional_info, file_path))
+            self.metadata_store.after_commit(lambda: self.metadata_cache.invalidate(file_path))
 
 
 STORAGE_CONFIG_JSON = os.getenv('STORAGE_CONFIG_JSON', '{"type": "file", "root": "storage"}')
 HISTORY_STORAGE_CONFIG_JSON = os.getenv('HISTORY_STORAGE_CONFIG_JSON', '{"type": "file", "root": "history"}')
 main_helper = StorageHelper(STORAGE_CONFIG_JSON)
 history_helper = StorageHelper(HISTORY_STORAGE_CONFIG_JSON)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await main_helper.open()
+    await history_helper.open()
+    yield
+    await history_helper.close()
+    await main_helper.close()
+
 # S3/GCS configuration
-app = FastAPI(title="File Storage API")
+app = FastAPI(title="File Storage API", lifespan=lifespan)
+instrument_app(app, "repository")
 
 
 #only assume POSIX path
-def get_next_version(file_path: str):
-    posix_path = pathlib.PurePosixPath(file_path)
-    suffix = posix_path.suffix
-    
-    # Get highest version number
-    conn = sqlite3.connect(history_helper.database_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT MAX(CAST(SUBSTR(file_path, LENGTH(?) + 2, LENGTH(file_path) - LENGTH(?) - LENGTH(?) - 1) AS INTEGER))
+async def get_next_version(file_path: str, conn=None):
+    # Get highest version number (index seek on (source_path, version))
+    sql = '''
+        SELECT MAX(version)
         FROM file_metadata 
-        WHERE file_path LIKE ? AND file_path GLOB ?
-    ''', (file_path, file_path, suffix, f"{file_path}.%.{suffix[1:]}", f"{file_path}.[0-9]*{suffix}"))
-    
-    result = cursor.fetchone()
-    conn.close()
+        WHERE source_path = ?
+    '''
+    if conn is not None:
+        async with conn.execute(sql, (file_path,)) as cursor:
+            result = await cursor.fetchone()
+    else:
+        result = await history_helper.metadata_store.fetchone(sql, (file_path,))
     
     # Get next version number (start from 1 if no existing versions)
     next_version = (result[0] or 0) + 1
     
     return next_version
 
-def get_latest_history_path(file_path: str):
+async def get_latest_history_path(file_path: str):
     """Get the latest existing version."""
-    conn = sqlite3.connect(history_helper.database_path)
-    cursor = conn.cursor()
-    posix_path = pathlib.PurePosixPath(file_path)
-    suffix = posix_path.suffix
-    base_path = str(posix_path.with_suffix(''))
-    
-    cursor.execute('''
+    result = await history_helper.metadata_store.fetchone('''
         SELECT file_path
         FROM file_metadata 
-        WHERE file_path LIKE ? AND file_path GLOB ?
-        ORDER BY CAST(SUBSTR(file_path, LENGTH(?) + 2, LENGTH(file_path) - LENGTH(?) - LENGTH(?) - 1) AS INTEGER) DESC
+        WHERE source_path = ?
+        ORDER BY version DESC
         LIMIT 1
-    ''', (f"{base_path}.%.{suffix[1:]}", f"{base_path}.[0-9]*{suffix}", base_path, base_path, suffix))
-    
-    result = cursor.fetchone()
-    conn.close()
+    ''', (file_path,))
     return result[0] if result else None
 
-def make_history_file_path(source_file_path: str, version: int) -> str:
-    suffix = pathlib.PurePosixPath(source_file_path).suffix
-    return  f"{source_file_path}.{version}{suffix}"
+async def get_next_version_path(file_path: str):
+    return make_history_file_path(file_path, await get_next_version(file_path))
 
-def get_next_version_path(file_path: str):
-    return make_history_file_path(file_path, get_next_version(file_path))
+def native_transfer(src_helper: StorageHelper, src_full_path: str, dst_helper: StorageHelper, dst_full_path: str) -> str:
+    """Copy a file with a backend-native O(1) operation, leaving the source in place; returns the operation used."""
+    dst_helper.ensure_parent_directories(dst_full_path)
+    try:
+        return _native_transfer(src_helper, src_full_path, dst_helper, dst_full_path)
+    finally:
+        dst_helper.invalidate_path(dst_full_path)
+
+def _native_transfer(src_helper: StorageHelper, src_full_path: str, dst_helper: StorageHelper, dst_full_path: str) -> str:
+    if src_helper.storage_type == 'file':
+        # The caller unlinks the source once the archive is committed; sources that stay live are never linked
+        os.link(src_full_path, dst_full_path)
+        return 'hard link'
+    # s3fs issues CopyObject, gcsfs a rewrite: the data never leaves the provider.
+    # The source is left in place; the upload that follows overwrites it.
+    src_helper.file_system.copy(src_full_path, dst_full_path)
+    return 'server-side copy'
 
-def move_to_history(source_file_path: str):
+def streamed_transfer(src_helper: StorageHelper, src_full_path: str, dst_helper: StorageHelper, dst_full_path: str) -> str:
+    dst_helper.ensure_parent_directories(dst_full_path)
+    try:
+        with stage("storage_copy", target=f"{src_helper.storage_type}->{dst_helper.storage_type}"):
+            with src_helper.file_system.open(src_full_path, 'rb') as src, dst_helper.file_system.open(dst_full_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                count_storage_bytes('copy', dst.tell())
+    finally:
+        dst_helper.invalidate_path(dst_full_path)
+    return 'streamed copy'
+
+async def add_blob_reference(conn, content_hash: str, size: int) -> bool:
+    """Count one more reference to a blob; True when the blob is new and its data must be stored."""
+    async with conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (content_hash,)) as cursor:
+        exists = await cursor.fetchone() is not None
+    if exists:
+        await conn.execute('UPDATE blobs SET ref_count = ref_count + 1 WHERE hash = ?', (content_hash,))
+    else:
+        await conn.execute('INSERT INTO blobs (hash, size, ref_count) VALUES (?, ?, 1)', (content_hash, size))
+    return not exists
+
+class StagingRequired(Exception):
+    """Raised inside the archive transaction when the data turns out to need a staged copy."""
+
+async def move_to_history(source_file_path: str, keep_source: bool = False):
+    """Archive the current file as the next history version.
+
+    keep_source leaves the current file in place (used when the upload is unchanged
+    and will not be rewritten).
+    """
     full_path = main_helper.get_absolute_path(source_file_path)
-    if not main_helper.file_system.exists(full_path):
+    if not await asyncio.to_thread(main_helper.exists, full_path):
         return  # File does not exist, nothing to move
-    with main_helper.file_system.open(full_path, 'rb') as src:
-        content = src.read()  # Synchronous read
-    history_file_path = get_next_version_path(source_file_path)
-    if not history_file_path:
-        history_file_path = make_history_file_path(source_file_path, 1)
-    history_helper.write_file_to_storage(history_file_path, content)
-    original_metadata = main_helper.get_file_metadata(source_file_path)
-    if original_metadata:
-        history_helper.save_file_metadata(history_file_path,
-            MetadataModel(
-                description=original_metadata['description'],
-                evaluation=original_metadata['evaluation'],
-                additional_info=original_metadata['additional_info']
-            ))
+    # Always record the version row, even without metadata, so version numbers keep increasing
+    original_metadata = await main_helper.get_file_metadata(source_file_path) or {
+        'description': '', 'evaluation': '', 'additional_info': '', 'content_hash': None
+    }
+    metadata = MetadataModel(
+        description=original_metadata['description'],
+        evaluation=original_metadata['evaluation'],
+        additional_info=original_metadata['additional_info']
+    )
+    content_hash = None
+    need_data = True
+    if history_helper.content_addressed:
+        content_hash = original_metadata['content_hash'] or await asyncio.to_thread(main_helper.hash_file, full_path)
+        # Only a hint: blob GC may remove the blob before the transaction, which re-checks
+        known = await history_helper.metadata_store.fetchone('SELECT 1 FROM blobs WHERE hash = ?', (content_hash,))
+        need_data = known is None
+    native = main_helper.same_backend(history_helper)
+    if keep_source and main_helper.storage_type == 'file':
+        # A hard link would leave the live file sharing its inode with the archived version
+        native = False
+    try:
+        await archive_version(source_file_path, full_path, metadata, content_hash,
+                              stage_data=need_data and not native, native=native, keep_source=keep_source)
+    except StagingRequired as e:
+        print(f"Archiving {source_file_path} needs a staged copy ({e}), retrying")
+        await archive_version(source_file_path, full_path, metadata, content_hash,
+                              stage_data=True, native=False, keep_source=keep_source)
+
+async def archive_version(source_file_path: str, full_path: str, metadata: MetadataModel, content_hash: Optional[str],
+                          stage_data: bool, native: bool, keep_source: bool):
+    """One archive attempt. Slow copies happen before the transaction (into a staging object),
+    so they never hold the history database's write lock; inside it only O(1) storage
+    operations run, and the current file is unlinked only after the commit."""
+    staged_path = None
+    if stage_data:
+        staged_path = history_helper.get_absolute_path(f".staging/{uuid.uuid4().hex}")
+        await asyncio.to_thread(streamed_transfer, main_helper, full_path, history_helper, staged_path)
+    data_full_path = None
+    linked = False
+    try:
+        # Version number, metadata row and the archived data commit (or roll back) together
+        async with history_helper.metadata_store.transaction() as conn:
+            version = await get_next_version(source_file_path, conn)
+            history_file_path = make_history_file_path(source_file_path, version)
+            need_data = True
+            if content_hash:
+                data_full_path = history_helper.blob_full_path(content_hash)
+                size = (await asyncio.to_thread(main_helper.get_file_info, full_path))['size']
+                need_data = await add_blob_reference(conn, content_hash, size)
+            else:
+                data_full_path = history_helper.get_absolute_path(history_file_path)
+            await history_helper.save_file_metadata(history_file_path, metadata,
+                                                    source_path=source_file_path, version=version,
+                                                    content_hash=content_hash, stored_as_blob=content_hash is not None,
+                                                    conn=conn)
+            if not need_data:
+                method = 'deduplicated'
+            elif staged_path:
+                history_helper.ensure_parent_directories(data_full_path)
+                await asyncio.to_thread(history_helper.file_system.mv, staged_path, data_full_path)
+                history_helper.invalidate_path(data_full_path)
+                staged_path = None
+                method = 'staged copy'
+            elif native:
+                try:
+                    method = await asyncio.to_thread(native_transfer, main_helper, full_path,
+                                                     history_helper, data_full_path)
+                except OSError as e:
+                    # e.g. a filesystem without hard links: roll back and stage instead
+                    raise StagingRequired(f"native copy failed: {e}")
+                linked = main_helper.storage_type == 'file'
+            else:
+                # The blob vanished (GC) after the pre-check that skipped staging
+                raise StagingRequired("blob no longer exists")
+    except BaseException:
+        if linked:
+            await asyncio.to_thread(remove_quietly, history_helper, data_full_path)
+        raise
+    finally:
+        if staged_path:
+            await asyncio.to_thread(remove_quietly, history_helper, staged_path)
+    if linked and not keep_source:
+        # The history link keeps the data; the upload must write a new file, not truncate it
+        await asyncio.to_thread(main_helper.file_system.rm, full_path)
+        main_helper.invalidate_path(full_path)
+    print(f"Archived {source_file_path} as {history_file_path} ({method})")
+
+def remove_quietly(helper: StorageHelper, full_path: str):
+    try:
+        helper.file_system.rm(full_path)
+    except Exception as e:
+        print(f"Failed to remove {full_path}: {e}")
+    finally:
+        helper.invalidate_path(full_path)
+
+async def resolve_history_full_path(file_path: str, version: int) -> str:
+    """Storage location of a history version: its blob when deduplicated, else its own file."""
+    history_file_path = make_history_file_path(file_path, version)
+    row = await history_helper.metadata_store.fetchone(
+        'SELECT content_hash, stored_as_blob FROM file_metadata WHERE file_path = ?', (history_file_path,))
+    if row and row[1]:
+        return history_helper.blob_full_path(row[0])
+    return history_helper.get_absolute_path(history_file_path)
+
+async def collect_blob_garbage(dry_run: bool = False, grace_seconds: float = 3600) -> Dict[str, Any]:
+    """Recount blob references and delete blobs nothing points at any more.
+
+    Blob files with no row at all (left by a crash mid-archive) are removed once they are
+    older than grace_seconds, so archives that are still in flight are never touched.
+    """
+    store = history_helper.metadata_store
+    removed = []
+    async with store.transaction() as conn:
+        await conn.execute('''
+            UPDATE blobs SET ref_count = (
+                SELECT COUNT(*) FROM file_metadata
+                WHERE file_metadata.content_hash = blobs.hash AND file_metadata.stored_as_blob = 1
+            )
+        ''')
+        async with conn.execute('SELECT hash, size FROM blobs WHERE ref_count = 0') as cursor:
+            unreferenced = await cursor.fetchall()
+        for content_hash, size in unreferenced:
+            if not dry_run:
+                await conn.execute('DELETE FROM blobs WHERE hash = ?', (content_hash,))
+            removed.append({'hash': content_hash, 'size': size})
+    # Rows a dry run left at zero references do not protect their files
+    known = {row[0] for row in await store.fetchall('SELECT hash FROM blobs WHERE ref_count > 0')}
+
+    def find_candidates():
+        fs = history_helper.file_system
+        blob_root = history_helper.get_absolute_path("blobs")
+        # An archive may have referenced a removed hash again since the commit above
+        candidates = [history_helper.blob_full_path(blob['hash']) for blob in removed if blob['hash'] not in known]
+        if fs.exists(blob_root):
+            now = time.time()
+            for path, info in fs.find(blob_root, detail=True).items():
+                if pathlib.PurePosixPath(path).name in known:
+                    continue
+                modified = info.get('mtime') or info.get('LastModified') or info.get('updated')
+                if isinstance(modified, datetime):
+                    modified = modified.timestamp()
+                if isinstance(modified, (int, float)) and now - modified >= grace_seconds and path not in candidates:
+                    candidates.append(path)
+        return candidates
+
+    def delete(paths):
+        for path in paths:
+            try:
+                history_helper.file_system.rm(path)
+            except FileNotFoundError:
+                pass
+            history_helper.invalidate_path(path)
+
+    candidates = await asyncio.to_thread(find_candidates)
+    if candidates and not dry_run:
+        # Blob files only appear inside an archive transaction, so with the write lock held
+        # the blob rows are final: re-read them and spare every hash referenced meanwhile
+        async with store.transaction() as conn:
+            async with conn.execute('SELECT hash FROM blobs WHERE ref_count > 0') as cursor:
+                known = {row[0] for row in await cursor.fetchall()}
+            candidates = [path for path in candidates if pathlib.PurePosixPath(path).name not in known]
+            await asyncio.to_thread(delete, candidates)
+    return {
+        'dry_run': dry_run,
+        'unreferenced_blobs': len(removed),
+        'freed_bytes': sum(blob['size'] for blob in removed),
+        'deleted_files': len(candidates),
+    }
 
 @app.post("/files/upload")
 async def upload_file(
@@ -236,39 +679,95 @@ async def upload_file(
         additional_info=additional_info
     )
     print(f"Uploading file: {file_path}, Description: {description}, Evaluation: {evaluation}, Additional Info: {additional_info}")
+    await file.seek(0)
+    content_hash = await asyncio.to_thread(hash_stream, file.file)
+    current = await main_helper.get_file_metadata(file_path)
+    unchanged = bool(current) and current['content_hash'] == content_hash
     #move to history if file already exists
-    move_to_history(file_path)
+    await move_to_history(file_path, keep_source=unchanged)
     print(f"Moved existing file to history: {file_path}")
-    # Write file to main storage
-    content = await file.read()
-    main_helper.write_file_to_storage(file_path, content)
-    main_helper.save_file_metadata(file_path, metadata)
+    if unchanged:
+        print(f"Content of {file_path} unchanged, skipping write")
+    else:
+        # Stream the (spooled) upload to main storage on a worker thread
+        await file.seek(0)
+        await asyncio.to_thread(main_helper.write_stream_to_storage, file_path, file.file)
+    await main_helper.save_file_metadata(file_path, metadata, content_hash=content_hash)
     return {"message": "File uploaded successfully"}
 
+def parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=" range into an inclusive (start, end); None means serve the whole file."""
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None  # Unsupported unit or multiple ranges: ignoring Range is allowed
+    start_text, _, end_text = ranges.strip().partition('-')
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            suffix_length = int(end_text)
+            if suffix_length <= 0:
+                raise ValueError
+            start = max(0, size - suffix_length)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
 @app.get("/files/download")
-async def download_file(file_path: str, version: Optional[int] = None):
-    full_path = main_helper.get_absolute_path(file_path)
-    
-    if not main_helper.file_system.exists(full_path):
-        raise HTTPException(status_code=404, detail="File not found")
+async def download_file(request: Request, file_path: str, version: Optional[int] = None):
     if version:
-        history_file_path = make_history_file_path(file_path, version)
-        full_history_path = main_helper.get_absolute_path(history_file_path)
-        content = history_helper.file_system.read_bytes(full_history_path)
+        helper = history_helper
+        full_path = await resolve_history_full_path(file_path, version)
     else:
-        content = main_helper.file_system.read_bytes(full_path)
+        helper = main_helper
+        full_path = main_helper.get_absolute_path(file_path)
+    
+    if not await asyncio.to_thread(helper.exists, full_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    info = await asyncio.to_thread(helper.get_file_info, full_path)
+    size, etag = info['size'], info['etag']
+    headers = {
+        "Content-Disposition": f"attachment; filename={os.path.basename(file_path)}",
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    byte_range = None
+    range_header = request.headers.get('range')
+    # If-Range: only honour Range when the client's copy is still current
+    if range_header and request.headers.get('if-range', etag) == etag:
+        byte_range = parse_range_header(range_header, size)
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            helper.iter_file(full_path, start, end - start + 1),
+            status_code=206,
+            media_type='application/octet-stream',
+            headers=headers
+        )
+    headers["Content-Length"] = str(size)
     return StreamingResponse(
-        iter([content]),
+        helper.iter_file(full_path),
         media_type='application/octet-stream',
-        headers={"Content-Disposition": f"attachment; filename={os.path.basename(file_path)}"}
+        headers=headers
     )
 
 @app.get("/files/metadata")
 async def get_metadata(file_path: str, version: Optional[int] = None):
     if version:
-        metadata = history_helper.get_file_metadata(make_history_file_path(file_path, version))
+        metadata = await history_helper.get_file_metadata(make_history_file_path(file_path, version))
     else:
-        metadata = main_helper.get_file_metadata(file_path)
+        metadata = await main_helper.get_file_metadata(file_path)
 
     if not metadata:
         raise HTTPException(status_code=404, detail="File or version not found")
@@ -279,7 +778,7 @@ async def get_metadata(file_path: str, version: Optional[int] = None):
 async def update_metadata(update: MetadataUpdate):
     """Update a specific parameter in file metadata"""
     try:
-        main_helper.update_metadata_parameter(update.file_path, update.parameter_name, update.value)
+        await main_helper.update_metadata_parameter(update.file_path, update.parameter_name, update.value)
         return {"message": "Metadata updated successfully"}
     except HTTPException:
         raise
@@ -288,27 +787,109 @@ async def update_metadata(update: MetadataUpdate):
 
 @app.get("/files/history-count")
 async def get_history_count(file_path: str):
-    return str(get_next_version(file_path) - 1)
+    return str(await get_next_version(file_path) - 1)
+
+@app.post("/files/metadata:batchGet")
+async def batch_get_metadata(request: MetadataBatchGet):
+    """Metadata for many files in one call; paths without metadata are listed in not_found"""
+    if len(request.file_paths) > METADATA_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {METADATA_BATCH_MAX} file_paths per request")
+    if request.version:
+        keys = {file_path: make_history_file_path(file_path, request.version) for file_path in request.file_paths}
+        rows = await history_helper.get_files_metadata(list(keys.values()))
+    else:
+        keys = {file_path: file_path for file_path in request.file_paths}
+        rows = await main_helper.get_files_metadata(request.file_paths)
+    metadata = {file_path: rows[key] for file_path, key in keys.items() if key in rows}
+    return {
+        "metadata": metadata,
+        "not_found": [file_path for file_path in keys if file_path not in metadata],
+    }
+
+@app.get("/files/search")
+async def search_files(q: str, prefix: bool = True, path_prefix: Optional[str] = None,
+                       limit: int = 50, offset: int = 0, version_history: bool = False):
+    """Full-text search over description, evaluation, additional_info and path.
+
+    Every word in q must match (as a word prefix unless prefix=false); results are ranked by
+    relevance and paged with limit/offset. path_prefix restricts results to a directory subtree.
+    """
+    if not 1 <= limit <= SEARCH_PAGE_MAX or offset < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {SEARCH_PAGE_MAX} and offset >= 0")
+    query = build_fts_query(q, prefix)
+    if not query:
+        raise HTTPException(status_code=400, detail="Query has no searchable words")
+    helper = history_helper if version_history else main_helper
+    # Fetch one extra row to know whether another page exists
+    results = await helper.search_metadata(query, path_prefix, limit + 1, offset)
+    next_offset = offset + limit if len(results) > limit else None
+    return {"results": results[:limit], "next_offset": next_offset}
 
 @app.get("/files/list")
-async def entity_list(root_path: str):
+async def entity_list(root_path: str, limit: Optional[int] = None, cursor: Optional[str] = None,
+                      include_metadata: bool = False):
+    """List a directory in name order.
+
+    One ls(detail=True) call gives names and types together. With limit, the response
+    carries next_cursor (the last path returned) to pass back for the following page;
+    include_metadata joins each file's metadata row.
+    """
+    if limit is not None and not 1 <= limit <= LIST_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {LIST_PAGE_MAX}")
     full_path = main_helper.get_absolute_path(root_path)
-    paths = main_helper.file_system.ls(full_path, detail=False)
+    entries = await asyncio.to_thread(main_helper.ls_detail, full_path)
     infos = []
-    for i in range(len(paths)):
-        isFile = main_helper.file_system.isfile(paths[i])
-        relative_path = pathlib.PurePosixPath(paths[i]).relative_to(main_helper.absolute_root)
+    for entry in entries:
+        relative_path = str(pathlib.PurePosixPath(entry['name']).relative_to(main_helper.absolute_root))
         infos.append({
             "path": relative_path,
-            "is_file": isFile,
+            "is_file": entry.get('type') == 'file',
+            "size": entry.get('size'),
         })
-    return {"entities": infos}
+    infos.sort(key=lambda info: info["path"])
+    if cursor:
+        infos = [info for info in infos if info["path"] > cursor]
+    next_cursor = None
+    if limit is not None and len(infos) > limit:
+        infos = infos[:limit]
+        next_cursor = infos[-1]["path"]
+    if include_metadata:
+        rows = await main_helper.get_files_metadata([info["path"] for info in infos if info["is_file"]])
+        for info in infos:
+            info["metadata"] = rows.get(info["path"])
+    return {"entities": infos, "next_cursor": next_cursor}
 
 @app.get("/")
 async def root():
     """API health check"""
     return {"message": "File Storage API is running", "storage_type": main_helper.storage_type}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit rates of the path/listing and metadata caches"""
+    return {"main": main_helper.cache_stats(), "history": history_helper.cache_stats()}
+
+@app.post("/admin/blob-gc")
+async def blob_gc(dry_run: bool = True, grace_seconds: float = 3600):
+    """Garbage-collect unreferenced history blobs (dry run unless dry_run=false)"""
+    return await collect_blob_garbage(dry_run, grace_seconds)
+
+async def run_blob_gc(dry_run: bool, grace_seconds: float):
+    await history_helper.open()
+    try:
+        print(json.dumps(await collect_blob_garbage(dry_run, grace_seconds), indent=2))
+    finally:
+        await history_helper.close()
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "gc":
+        # python main.py gc [--dry-run] [--grace-seconds N]
+        import argparse
+        parser = argparse.ArgumentParser(prog="main.py gc", description="Delete unreferenced history blobs")
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument("--grace-seconds", type=float, default=3600)
+        args = parser.parse_args(sys.argv[2:])
+        asyncio.run(run_blob_gc(args.dry_run, args.grace_seconds))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
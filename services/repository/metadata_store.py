@@ -0,0 +1,234 @@
+import asyncio
+import pathlib
+import re
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+import aiosqlite
+from instrumentation import stage
+
+# Applied to every connection. WAL lets readers run while the writer commits;
+# busy_timeout makes writers from other processes wait instead of failing with "database is locked".
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+    # INSERT OR REPLACE must fire the delete trigger too, or the search index keeps stale rows
+    "PRAGMA recursive_triggers=ON",
+]
+
+# Split points of a history file name: ".<digits>" not followed by another directory
+HISTORY_VERSION_PATTERN = re.compile(r'\.([0-9]+)(?=[^/]*$)')
+
+def make_history_file_path(source_file_path: str, version: int) -> str:
+    suffix = pathlib.PurePosixPath(source_file_path).suffix
+    return f"{source_file_path}.{version}{suffix}"
+
+def parse_history_file_path(file_path: str) -> Optional[Tuple[str, int]]:
+    """Invert make_history_file_path: (source_path, version), or None for other names.
+
+    Sources may end in ".<digits>" themselves ("take.2" is archived as "take.2.3.2"), so every
+    split point is tried; at most one of them reproduces the name.
+    """
+    for match in HISTORY_VERSION_PATTERN.finditer(file_path):
+        source, version = file_path[:match.start()], int(match.group(1))
+        if source and make_history_file_path(source, version) == file_path:
+            return source, version
+    return None
+
+async def _backfill_versions(conn: aiosqlite.Connection, batch_size: int = 10000):
+    """Fill source_path/version for rows written before those columns existed.
+
+    Only history databases are ever queried by version; main-storage rows that happen
+    to look like history names get values too, which is harmless.
+    """
+    last_id = 0
+    while True:
+        async with conn.execute(
+            'SELECT id, file_path FROM file_metadata WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, file_path in rows:
+            parsed = parse_history_file_path(file_path)
+            if parsed:
+                updates.append((parsed[0], parsed[1], row_id))
+        await conn.executemany('UPDATE file_metadata SET source_path = ?, version = ? WHERE id = ?', updates)
+        last_id = rows[-1][0]
+
+# Applied in order; PRAGMA user_version records how many have run on a database.
+# Each entry is a list of SQL statements or a coroutine taking the connection.
+MIGRATIONS = [
+    ['''
+        CREATE TABLE IF NOT EXISTS file_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT UNIQUE NOT NULL,
+            description TEXT NOT NULL,
+            evaluation TEXT NOT NULL,
+            additional_info TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''],
+    # Explicit version columns so history lookups are index seeks instead of LIKE/GLOB scans
+    [
+        'ALTER TABLE file_metadata ADD COLUMN source_path TEXT',
+        'ALTER TABLE file_metadata ADD COLUMN version INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_file_metadata_source_version ON file_metadata (source_path, version)',
+    ],
+    _backfill_versions,
+    # Content-addressed history: rows may point at a shared blob, blobs are reference counted
+    [
+        'ALTER TABLE file_metadata ADD COLUMN content_hash TEXT',
+        'ALTER TABLE file_metadata ADD COLUMN stored_as_blob INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_file_metadata_content_hash ON file_metadata (content_hash)',
+        '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    # Full-text index over the metadata text, kept in sync by triggers on every write path
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS file_metadata_fts USING fts5(
+            file_path, description, evaluation, additional_info,
+            content='file_metadata', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS file_metadata_fts_insert AFTER INSERT ON file_metadata BEGIN
+            INSERT INTO file_metadata_fts (rowid, file_path, description, evaluation, additional_info)
+            VALUES (new.id, new.file_path, new.description, new.evaluation, new.additional_info);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS file_metadata_fts_delete AFTER DELETE ON file_metadata BEGIN
+            INSERT INTO file_metadata_fts (file_metadata_fts, rowid, file_path, description, evaluation, additional_info)
+            VALUES ('delete', old.id, old.file_path, old.description, old.evaluation, old.additional_info);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS file_metadata_fts_update AFTER UPDATE OF file_path, description, evaluation, additional_info
+        ON file_metadata BEGIN
+            INSERT INTO file_metadata_fts (file_metadata_fts, rowid, file_path, description, evaluation, additional_info)
+            VALUES ('delete', old.id, old.file_path, old.description, old.evaluation, old.additional_info);
+            INSERT INTO file_metadata_fts (rowid, file_path, description, evaluation, additional_info)
+            VALUES (new.id, new.file_path, new.description, new.evaluation, new.additional_info);
+        END
+        ''',
+        "INSERT INTO file_metadata_fts (file_metadata_fts) VALUES ('rebuild')",
+    ],
+]
+
+class MetadataStore:
+    """Long-lived SQLite connections for one database: a single writer plus a pool of readers.
+
+    Queries run on aiosqlite's per-connection threads, so they never block the event loop,
+    and each connection keeps its compiled statements cached across calls.
+    """
+    def __init__(self, database_path: str, readers: int = 4, statement_cache_size: int = 256):
+        self.database_path = database_path
+        self.readers = max(1, readers)
+        self.statement_cache_size = statement_cache_size
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._reader_connections: List[aiosqlite.Connection] = []
+        self._after_commit: List[Callable[[], None]] = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        # isolation_level=None: we issue BEGIN IMMEDIATE ourselves in transaction()
+        conn = await aiosqlite.connect(self.database_path, isolation_level=None,
+                                       cached_statements=self.statement_cache_size)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        print(f"Initializing database at {self.database_path}")
+        self._writer = await self._connect()
+        await self.migrate()
+        self._reader_pool = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect()
+            self._reader_connections.append(conn)
+            self._reader_pool.put_nowait(conn)
+
+    async def migrate(self):
+        async with self._writer.execute('PRAGMA user_version') as cursor:
+            current = (await cursor.fetchone())[0]
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= current:
+                continue
+            print(f"Applying metadata migration {number} to {self.database_path}")
+            async with self.transaction() as conn:
+                if callable(migration):
+                    await migration(conn)
+                else:
+                    for statement in migration:
+                        await conn.execute(statement)
+                await conn.execute(f'PRAGMA user_version = {number}')
+
+    async def close(self):
+        for conn in self._reader_connections:
+            await conn.close()
+        self._reader_connections.clear()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Serialise writes on the writer connection; commit on success, roll back on error."""
+        # Timed from before the write lock is taken, so lock contention shows up in the metric
+        with stage("sqlite_transaction"):
+            async with self._write_lock:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._writer
+                    await self._writer.commit()
+                except BaseException:
+                    self._after_commit.clear()
+                    await self._writer.rollback()
+                    raise
+                callbacks, self._after_commit = self._after_commit, []
+                for callback in callbacks:
+                    callback()
+
+    def after_commit(self, callback: Callable[[], None]):
+        """Run callback once the current transaction commits (dropped if it rolls back)."""
+        self._after_commit.append(callback)
+
+    async def fetchone(self, sql: str, params: Iterable[Any] = ()):
+        async with self.reader() as conn:
+            with stage("sqlite_query"):
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: Iterable[Any] = ()):
+        async with self.reader() as conn:
+            with stage("sqlite_query"):
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()):
+        async with self.transaction() as conn:
+            await conn.execute(sql, params)
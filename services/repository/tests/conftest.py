@@ -0,0 +1,39 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import pytest
+
+# main.py builds its storage helpers at import time; point them at a throwaway directory
+_root = tempfile.mkdtemp(prefix="repository-tests-")
+os.environ.setdefault("STORAGE_CONFIG_JSON", f'{{"type": "file", "root": "{_root}/storage"}}')
+os.environ.setdefault("HISTORY_STORAGE_CONFIG_JSON", f'{{"type": "file", "root": "{_root}/history"}}')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import main
+
+@pytest.fixture
+def helpers(tmp_path, monkeypatch):
+    """Fresh main/history storage; yields an async runner that opens and closes their databases."""
+    def make(content_addressed=False):
+        (tmp_path / "storage").mkdir(exist_ok=True)
+        (tmp_path / "history").mkdir(exist_ok=True)
+        storage = main.StorageHelper(json.dumps({"type": "file", "root": str(tmp_path / "storage")}))
+        history = main.StorageHelper(json.dumps({"type": "file", "root": str(tmp_path / "history"),
+                                                 "content_addressed": content_addressed}))
+        monkeypatch.setattr(main, "main_helper", storage)
+        monkeypatch.setattr(main, "history_helper", history)
+        return storage, history
+
+    def within(storage, history, coro_fn):
+        async def body():
+            await storage.open()
+            await history.open()
+            try:
+                return await coro_fn()
+            finally:
+                await history.close()
+                await storage.close()
+        return asyncio.run(body())
+
+    return make, within
@@ -0,0 +1,96 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+from main import parse_range_header
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-3", (0, 3)),
+    ("bytes=2-2", (2, 2)),
+    ("bytes=4-", (4, 9)),
+    ("bytes=-3", (7, 9)),
+    ("bytes=-50", (0, 9)),  # suffix longer than the file
+    ("bytes=5-100", (5, 9)),  # end clamped to the last byte
+    ("Bytes = 1-2", (1, 2)),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 10) == expected
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-1,4-5",  # multiple ranges
+    "bytes=0-1, 4-5",
+    "items=0-3",
+    "bytes=abc",
+    "bytes=-",
+    "bytes=a-3",
+    "bytes=-0",
+    "0-3",
+])
+def test_parse_range_header_ignored(header):
+    assert parse_range_header(header, 10) is None
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=10-20", "bytes=5-2"])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(HTTPException) as error:
+        parse_range_header(header, 10)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */10"
+
+def test_parse_range_header_empty_file():
+    with pytest.raises(HTTPException) as error:
+        parse_range_header("bytes=-5", 0)
+    assert error.value.status_code == 416
+
+def make_request(**headers):
+    return Request({"type": "http", "method": "GET", "path": "/files/download",
+                    "headers": [(key.replace("_", "-").encode(), value.encode()) for key, value in headers.items()]})
+
+async def read_body(response):
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+def download(helpers, file_path, version=None, **headers):
+    _, within = helpers
+
+    async def body():
+        response = await main.download_file(make_request(**headers), file_path, version)
+        return response, await read_body(response)
+    return within(main.main_helper, main.history_helper, body)
+
+@pytest.mark.parametrize("file_path", ["a/mix.final.v2.wav", "a/noext", "x.tar.gz"])
+def test_download_range(helpers, file_path):
+    make, _ = helpers
+    storage, _ = make()
+    storage.write_file_to_storage(file_path, b"0123456789")
+    response, content = download(helpers, file_path)
+    assert response.status_code == 200 and content == b"0123456789"
+    assert response.headers["Content-Length"] == "10"
+
+    response, content = download(helpers, file_path, range="bytes=-4")
+    assert response.status_code == 206 and content == b"6789"
+    assert response.headers["Content-Range"] == "bytes 6-9/10"
+    assert response.headers["Content-Length"] == "4"
+
+@pytest.mark.parametrize("file_path", ["a/mix.final.v2.wav", "a/noext", "x.tar.gz"])
+def test_download_history_version_range(helpers, file_path):
+    make, _ = helpers
+    _, history = make()
+    history.write_file_to_storage(main.make_history_file_path(file_path, 2), b"old version")
+    response, content = download(helpers, file_path, version=2, range="bytes=4-")
+    assert response.status_code == 206 and content == b"version"
+    assert response.headers["Content-Disposition"].endswith(file_path.rsplit("/", 1)[-1])
+
+def test_download_range_out_of_bounds(helpers):
+    make, _ = helpers
+    storage, _ = make()
+    storage.write_file_to_storage("a/track.wav", b"0123456789")
+    with pytest.raises(HTTPException) as error:
+        download(helpers, "a/track.wav", range="bytes=10-")
+    assert error.value.status_code == 416
+
+def test_download_stale_if_range_gets_full_file(helpers):
+    make, _ = helpers
+    storage, _ = make()
+    storage.write_file_to_storage("a/track.wav", b"0123456789")
+    response, content = download(helpers, "a/track.wav", range="bytes=0-1", if_range='"stale"')
+    assert response.status_code == 200 and content == b"0123456789"
@@ -0,0 +1,127 @@
+import io
+import os
+import pytest
+from fastapi import UploadFile
+
+import main
+
+def metadata():
+    return main.MetadataModel(description="d", evaluation="e", additional_info="{}")
+
+async def store(helper, file_path, content):
+    helper.write_file_to_storage(file_path, content)
+    await helper.save_file_metadata(file_path, metadata(), content_hash=None)
+
+def test_archive_moves_file_after_commit(helpers):
+    make, within = helpers
+    storage, history = make()
+
+    async def body():
+        await store(storage, "a/track.wav", b"v1")
+        await main.move_to_history("a/track.wav")
+    within(storage, history, body)
+    assert not os.path.exists(storage.get_absolute_path("a/track.wav"))
+    with open(history.get_absolute_path("a/track.wav.1.wav"), "rb") as f:
+        assert f.read() == b"v1"
+
+def test_failed_commit_keeps_current_file(helpers, monkeypatch):
+    make, within = helpers
+    storage, history = make()
+
+    async def failing_commit():
+        raise RuntimeError("disk I/O error")
+
+    async def body():
+        await store(storage, "a/track.wav", b"v1")
+        monkeypatch.setattr(history.metadata_store._writer, "commit", failing_commit)
+        with pytest.raises(RuntimeError):
+            await main.move_to_history("a/track.wav")
+    within(storage, history, body)
+    with open(storage.get_absolute_path("a/track.wav"), "rb") as f:
+        assert f.read() == b"v1"
+    assert not os.path.exists(history.get_absolute_path("a/track.wav.1.wav"))
+
+def test_cross_device_roots_are_staged(helpers, monkeypatch):
+    make, within = helpers
+    storage, history = make()
+    monkeypatch.setattr(main, "existing_device", lambda path: 1 if "history" in path else 0)
+    transactions_open = []
+
+    def streamed(*args):
+        transactions_open.append(history.metadata_store._write_lock.locked())
+        return real_streamed(*args)
+    real_streamed = main.streamed_transfer
+    monkeypatch.setattr(main, "streamed_transfer", streamed)
+
+    async def body():
+        await store(storage, "a/track.wav", b"v1")
+        await main.move_to_history("a/track.wav")
+    within(storage, history, body)
+    assert transactions_open == [False]
+    with open(history.get_absolute_path("a/track.wav.1.wav"), "rb") as f:
+        assert f.read() == b"v1"
+
+def test_blob_collected_after_precheck_is_staged(helpers, monkeypatch):
+    make, within = helpers
+    storage, history = make(content_addressed=True)
+    monkeypatch.setattr(main, "existing_device", lambda path: 1 if "history" in path else 0)
+    real_fetchone = history.metadata_store.fetchone
+
+    async def stale_precheck(sql, params=()):
+        # The pre-check sees the blob; GC removes it before the archive transaction
+        if "FROM blobs" in sql:
+            return (1,)
+        return await real_fetchone(sql, params)
+
+    async def body():
+        await store(storage, "a/track.wav", b"v1")
+        monkeypatch.setattr(history.metadata_store, "fetchone", stale_precheck)
+        await main.move_to_history("a/track.wav")
+        return await real_fetchone("SELECT content_hash FROM file_metadata WHERE file_path = ?", ("a/track.wav.1.wav",))
+    (content_hash,) = within(storage, history, body)
+    with open(history.blob_full_path(content_hash), "rb") as f:
+        assert f.read() == b"v1"
+
+async def upload(file_path, content):
+    await main.upload_file(file=UploadFile(io.BytesIO(content), filename="t.wav"), file_path=file_path,
+                           description="d", evaluation="e", additional_info="{}")
+
+async def read_version(file_path, version):
+    full_path = await main.resolve_history_full_path(file_path, version)
+    with open(full_path, "rb") as f:
+        return f.read()
+
+def test_identical_then_different_upload_keeps_history(helpers):
+    make, within = helpers
+    storage, history = make(content_addressed=True)
+
+    async def body():
+        await upload("t.wav", b"XXXX")
+        await upload("t.wav", b"XXXX")  # unchanged: the live file stays in place
+        await upload("t.wav", b"YYYYYYYY")
+        return [await read_version("t.wav", version) for version in (1, 2)]
+    assert within(storage, history, body) == [b"XXXX", b"XXXX"]
+    with open(storage.get_absolute_path("t.wav"), "rb") as f:
+        assert f.read() == b"YYYYYYYY"
+
+def test_blob_garbage_collection_spares_rereferenced_blob(helpers, monkeypatch):
+    make, within = helpers
+    storage, history = make(content_addressed=True)
+    real_fetchall = history.metadata_store.fetchall
+
+    async def archive_after_read(sql, params=()):
+        rows = await real_fetchall(sql, params)
+        if "FROM blobs" in sql:
+            # The same content is archived again right after GC read the live hashes
+            await store(storage, "a/track.wav", b"v1")
+            await main.move_to_history("a/track.wav")
+        return rows
+
+    async def body():
+        await store(storage, "a/track.wav", b"v1")
+        await main.move_to_history("a/track.wav")
+        await history.metadata_store.execute("DELETE FROM file_metadata WHERE file_path = ?", ("a/track.wav.1.wav",))
+        monkeypatch.setattr(history.metadata_store, "fetchall", archive_after_read)
+        await main.collect_blob_garbage(grace_seconds=0)
+        return await read_version("a/track.wav", 1)
+    assert within(storage, history, body) == b"v1"
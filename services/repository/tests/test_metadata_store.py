@@ -0,0 +1,110 @@
+import asyncio
+import sqlite3
+import pytest
+
+from metadata_store import (MIGRATIONS, MetadataStore, _backfill_versions, make_history_file_path,
+                            parse_history_file_path)
+
+@pytest.mark.parametrize("file_path, expected", [
+    ("a/b.wav.3.wav", ("a/b.wav", 3)),
+    ("song.final.mp3.12.mp3", ("song.final.mp3", 12)),
+    ("x.tar.gz.2.gz", ("x.tar.gz", 2)),
+    ("noext.1", ("noext", 1)),
+    ("dir.v2/noext.7", ("dir.v2/noext", 7)),
+    (".hidden.4", (".hidden", 4)),
+    # Sources that end in ".<digits>" themselves
+    ("a.1.2.1", ("a.1", 2)),
+    ("take.2.3.5.3", ("take.2.3", 5)),
+    ("mix.v1.3.wav.4.wav", ("mix.v1.3.wav", 4)),
+    (".5.1", (".5", 1)),
+])
+def test_parse_history_file_path(file_path, expected):
+    assert parse_history_file_path(file_path) == expected
+
+@pytest.mark.parametrize("file_path", [
+    "a/b.wav",
+    "noext",
+    "track.1.wav",  # a main-storage name, the suffix does not repeat the source's
+    "b.wav.3.mp3",
+    "b.wav.x.wav",
+    "dir.3/file",
+    ".5",
+])
+def test_parse_history_file_path_rejects(file_path):
+    assert parse_history_file_path(file_path) is None
+
+@pytest.mark.parametrize("source", ["a/b.wav", "x.tar.gz", "noext", "dir.v2/noext", "song.final.mp3",
+                                    "a.1", "take.2.3", "mix.v1.3.wav", "1.2.3"])
+def test_parse_round_trips_make_history_file_path(source):
+    assert parse_history_file_path(make_history_file_path(source, 9)) == (source, 9)
+
+def test_migrate_from_v0_database(tmp_path):
+    database_path = str(tmp_path / "metadata.db")
+    # The schema as the service created it before migrations were tracked
+    conn = sqlite3.connect(database_path)
+    conn.execute('''
+        CREATE TABLE file_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT UNIQUE NOT NULL,
+            description TEXT NOT NULL,
+            evaluation TEXT NOT NULL,
+            additional_info TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    paths = ["a/b.wav.3.wav", "x.tar.gz.2.gz", "noext.1", "a.1.2.1", "take.2.3.5.3", "mix.v1.3.wav.4.wav",
+             "a/b.wav", "track.1.wav"]
+    conn.executemany('INSERT INTO file_metadata (file_path, description, evaluation) VALUES (?, ?, ?)',
+                     [(path, "guitar solo", "good") for path in paths])
+    conn.commit()
+    conn.close()
+
+    async def run():
+        store = MetadataStore(database_path, readers=1)
+        await store.open()
+        try:
+            version = (await store.fetchone('PRAGMA user_version'))[0]
+            rows = await store.fetchall('SELECT file_path, source_path, version FROM file_metadata ORDER BY id')
+            hits = await store.fetchall(
+                'SELECT file_metadata.file_path FROM file_metadata_fts '
+                'JOIN file_metadata ON file_metadata.id = file_metadata_fts.rowid '
+                'WHERE file_metadata_fts MATCH ? ORDER BY file_metadata.id', ("guitar",))
+            # Opening again must not re-run anything
+            await store.migrate()
+            assert (await store.fetchone('PRAGMA user_version'))[0] == version
+        finally:
+            await store.close()
+        return version, rows, hits
+
+    version, rows, hits = asyncio.run(run())
+    assert version == len(MIGRATIONS)
+    assert [tuple(row) for row in rows] == [
+        ("a/b.wav.3.wav", "a/b.wav", 3),
+        ("x.tar.gz.2.gz", "x.tar.gz", 2),
+        ("noext.1", "noext", 1),
+        ("a.1.2.1", "a.1", 2),
+        ("take.2.3.5.3", "take.2.3", 5),
+        ("mix.v1.3.wav.4.wav", "mix.v1.3.wav", 4),
+        ("a/b.wav", None, None),
+        ("track.1.wav", None, None),
+    ]
+    assert [row[0] for row in hits] == paths
+
+def test_backfill_pages_through_batches(tmp_path):
+    database_path = str(tmp_path / "metadata.db")
+
+    async def run():
+        store = MetadataStore(database_path, readers=1)
+        await store.open()
+        try:
+            async with store.transaction() as conn:
+                await conn.executemany(
+                    'INSERT INTO file_metadata (file_path, description, evaluation) VALUES (?, ?, ?)',
+                    [(f"t{i}.wav.{i}.wav", "", "") for i in range(1, 8)])
+                await _backfill_versions(conn, batch_size=3)
+            return await store.fetchall('SELECT source_path, version FROM file_metadata ORDER BY id')
+        finally:
+            await store.close()
+
+    assert [tuple(row) for row in asyncio.run(run())] == [(f"t{i}.wav", i) for i in range(1, 8)]
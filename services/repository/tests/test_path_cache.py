@@ -0,0 +1,35 @@
+import io
+import fsspec
+import pytest
+
+from main import StorageHelper, parent_path_keys, path_cache_key
+
+@pytest.mark.parametrize("full_path, expected", [
+    ("s3://bucket/dir/x", ["s3://bucket/dir", "s3://bucket"]),
+    ("gcs://bucket/x", ["gcs://bucket"]),
+    ("/srv/storage/a/b.wav", ["/srv/storage/a", "/srv/storage", "/srv", "/"]),
+    ("s3://bucket/dir/", ["s3://bucket"]),
+])
+def test_parent_path_keys(full_path, expected):
+    assert parent_path_keys(full_path) == expected
+
+@pytest.mark.parametrize("full_path, expected", [
+    ("s3://bucket/dir/", "s3://bucket/dir"),
+    ("s3://bucket/dir", "s3://bucket/dir"),
+    ("s3://", "s3://"),
+    ("/", "/"),
+])
+def test_path_cache_key(full_path, expected):
+    assert path_cache_key(full_path) == expected
+
+def test_write_invalidates_listing_under_protocol_root(tmp_path):
+    helper = StorageHelper(f'{{"type": "file", "root": "{tmp_path}", "cache_ttl_seconds": 60}}')
+    helper.file_system = fsspec.filesystem("memory")
+    helper.absolute_root = "memory://cache-test"
+    helper.file_system.makedirs("memory://cache-test/dir", exist_ok=True)
+
+    # /files/list asks for the root with a trailing slash
+    assert helper.ls_detail(helper.get_absolute_path("dir/")) == []
+    helper.write_stream_to_storage("dir/track.wav", io.BytesIO(b"audio"))
+    assert len(helper.ls_detail(helper.get_absolute_path("dir/"))) == 1
+    assert len(helper.ls_detail(helper.get_absolute_path("dir"))) == 1
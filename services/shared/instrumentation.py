@@ -0,0 +1,287 @@
+"""Metrics, trace IDs and structured logs shared by all services.
+
+instrument_app(app, service) adds:
+  - GET /metrics in the Prometheus text format, with per-route request histograms and
+    the per-stage histograms recorded through stage() / observe_stage();
+  - trace ID propagation: X-Trace-Id (or a W3C traceparent) is taken from the request or
+    generated, echoed on the response and available as current_trace_id() / trace_headers()
+    for calls to other services;
+  - an access log event per request, sent with log_event() to fluent-bit.
+
+log_event() never blocks the caller: events go onto a bounded queue that a daemon thread
+POSTs in batches to FLUENT_BIT_URL (the fluent-bit HTTP input, e.g. http://fluent-bit:8888/app.log).
+When the queue is full events are dropped and counted; without FLUENT_BIT_URL nothing is sent.
+"""
+import bisect
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+TRACE_HEADER = "X-Trace-Id"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_service_name = os.getenv("SERVICE_NAME", "")
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return "\n".join(lines)
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return "\n".join(lines)
+
+REGISTRY = []
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time from request start to the last response byte",
+                             ("service", "method", "route", "status"))
+STAGE_DURATION = Histogram("stage_duration_seconds", "Time spent in one processing stage of a request",
+                           ("service", "stage", "target"))
+STORAGE_BYTES = Counter("storage_io_bytes_total", "Bytes moved to and from storage", ("service", "direction"))
+LOG_EVENTS_DROPPED = Counter("log_events_dropped_total", "Structured log events dropped because the queue was full",
+                             ("service",))
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+def observe_stage(stage_name: str, seconds: float, target: str = ""):
+    STAGE_DURATION.observe(seconds, service=_service_name, stage=stage_name, target=target)
+
+@contextmanager
+def stage(stage_name: str, target: str = ""):
+    """Time a block as one stage, e.g. `with stage("inference"):`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage_name, time.perf_counter() - started, target)
+
+def count_storage_bytes(direction: str, amount: int):
+    STORAGE_BYTES.inc(amount, service=_service_name, direction=direction)
+
+# Trace IDs
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+def trace_headers() -> Dict[str, str]:
+    trace_id = _trace_id.get()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+@contextmanager
+def use_trace_id(trace_id: Optional[str]):
+    """Run a block (e.g. a background job) under the trace ID of the request that started it."""
+    token = _trace_id.set(trace_id or uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+def _incoming_trace_id(headers: Dict[bytes, bytes]) -> str:
+    trace_id = headers.get(TRACE_HEADER.lower().encode())
+    if trace_id:
+        return trace_id.decode("latin-1")[:64]
+    traceparent = headers.get(b"traceparent")
+    if traceparent:
+        parts = traceparent.decode("latin-1").split("-")
+        if len(parts) >= 2 and len(parts[1]) == 32:
+            return parts[1]
+    return uuid.uuid4().hex
+
+# Structured logs
+
+class FluentSender:
+    """Ships JSON events to a fluent-bit HTTP input from a background thread."""
+    def __init__(self, url: str, max_queue: int = 10000, batch_size: int = 200, flush_seconds: float = 1.0,
+                 timeout: float = 5.0):
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.timeout = timeout
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="fluent-sender", daemon=True)
+        self._thread.start()
+
+    def send(self, event: dict):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            LOG_EVENTS_DROPPED.inc(service=_service_name)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                request = urllib.request.Request(self.url, data=json.dumps(batch, default=str).encode(),
+                                                 headers={"Content-Type": "application/json"}, method="POST")
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+            except Exception as e:
+                LOG_EVENTS_DROPPED.inc(len(batch), service=_service_name)
+                print(f"Could not ship {len(batch)} log events to {self.url}: {e}")
+
+_sender: Optional[FluentSender] = None
+_sender_lock = threading.Lock()
+
+def _get_sender() -> Optional[FluentSender]:
+    global _sender
+    url = os.getenv("FLUENT_BIT_URL", "")
+    if not url:
+        return None
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                _sender = FluentSender(url, max_queue=int(os.getenv("FLUENT_BIT_MAX_QUEUE", "10000")))
+    return _sender
+
+def log_event(event: str, **fields):
+    """Queue a structured log event for fluent-bit; returns immediately."""
+    sender = _get_sender()
+    if sender is None:
+        return
+    record = {"time": time.time(), "service": _service_name, "event": event, "trace_id": _trace_id.get()}
+    record.update(fields)
+    sender.send(record)
+
+# ASGI integration
+
+class InstrumentationMiddleware:
+    """Times every request up to its last body chunk (so streamed responses count fully)."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        trace_id = _incoming_trace_id(headers)
+        token = _trace_id.set(trace_id)
+        started = time.perf_counter()
+        status = 500
+        finished = False
+
+        def record():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            duration = time.perf_counter() - started
+            REQUEST_DURATION.observe(duration, service=_service_name, method=scope["method"],
+                                     route=route_path, status=status)
+            if route_path != "/metrics":
+                log_event("request", method=scope["method"], route=route_path, path=scope["path"],
+                          status=status, duration_ms=round(duration * 1000, 3))
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # Replace rather than append: relayed upstream responses already carry one
+                header_name = TRACE_HEADER.lower().encode()
+                message["headers"] = [(name, value) for name, value in message.get("headers", [])
+                                      if name.lower() != header_name] + [(header_name, trace_id.encode())]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
+            _trace_id.reset(token)
+
+def instrument_app(app, service_name: str):
+    """Add /metrics, request timing, trace IDs and access logs to a FastAPI app."""
+    global _service_name
+    _service_name = _service_name or service_name
+    from fastapi.responses import PlainTextResponse
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+    app.add_middleware(InstrumentationMiddleware)
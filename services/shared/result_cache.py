@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+def make_cache_key(content_hash: str, **params) -> str:
+    """Key = hash of the input bytes + the parameters that influence the output."""
+    param_json = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(f"{content_hash}:{param_json}".encode("utf-8")).hexdigest()
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(file, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a seekable file object in chunks and rewind it."""
+    digest = hashlib.sha256()
+    file.seek(0)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+class ResultCache:
+    """Content-addressed result cache: in-memory LRU with an optional size-bounded disk tier.
+
+    Async handlers use get_async / put_async, which keep the disk tier's file I/O (and the
+    occasional eviction scan) off the event loop.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024,
+                 disk_dir: Optional[str] = None, disk_max_bytes: int = 4 * 1024 * 1024 * 1024,
+                 disk_low_water: float = 0.9):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        # Eviction frees down to this fraction of the limit, so it runs once per batch of puts
+        self.disk_low_water = disk_low_water
+        self._evicting = False
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    @classmethod
+    def from_env(cls, prefix: str = "RESULT_CACHE"):
+        return cls(
+            max_entries=int(os.getenv(f"{prefix}_ENTRIES", "1024")),
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(256 * 1024 * 1024))),
+            disk_dir=os.getenv(f"{prefix}_DIR", ""),
+            disk_max_bytes=int(os.getenv(f"{prefix}_DISK_MAX_BYTES", str(4 * 1024 * 1024 * 1024))),
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        with self._lock:
+            self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    async def get_async(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return self.get(key)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+        return await asyncio.to_thread(self.get, key)
+
+    async def put_async(self, key: str, value: bytes):
+        with self._lock:
+            self._memory_put(key, value)
+        if self.disk_dir:
+            await asyncio.to_thread(self._disk_put, key, value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_enabled": self.disk_dir is not None,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _memory_put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_entries(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # mtime doubles as last-access time for eviction
+        return value
+
+    def _disk_put(self, key: str, value: bytes):
+        if not self.disk_dir or len(value) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(value)
+            # One scan at a time; puts arriving meanwhile are covered by the low-water margin
+            evict = self._disk_bytes > self.disk_max_bytes and not self._evicting
+            if evict:
+                self._evicting = True
+        if evict:
+            try:
+                self._evict_disk()
+            finally:
+                with self._lock:
+                    self._evicting = False
+
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * self.disk_low_water
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
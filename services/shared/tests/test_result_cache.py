@@ -0,0 +1,32 @@
+import asyncio
+import os
+import time
+
+from result_cache import ResultCache
+
+def disk_files(cache):
+    return [name for _, _, files in os.walk(cache.disk_dir) for name in files]
+
+def test_disk_eviction_frees_down_to_low_water(tmp_path):
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000, disk_low_water=0.5)
+    for i in range(10):
+        cache.put(f"{i:02d}key", b"x" * 100)
+        # mtime orders the entries for eviction
+        os.utime(cache._disk_path(f"{i:02d}key"), (time.time() - 100 + i, time.time() - 100 + i))
+    assert len(disk_files(cache)) == 10
+    cache.put("10key", b"x" * 100)
+    assert cache.stats()["disk_bytes"] <= 500
+    assert cache.get("00key") is None
+    assert cache.get("10key") == b"x" * 100
+
+def test_async_round_trip_through_disk(tmp_path):
+    async def body():
+        writer = ResultCache(disk_dir=str(tmp_path))
+        await writer.put_async("abkey", b"value")
+        # A fresh instance (another worker) only has the disk tier
+        reader = ResultCache(disk_dir=str(tmp_path))
+        return await reader.get_async("abkey"), await reader.get_async("cdkey"), reader.stats()
+    value, missing, stats = asyncio.run(body())
+    assert value == b"value"
+    assert missing is None
+    assert stats["disk_hits"] == 1 and stats["misses"] == 1
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from PIL import Image, ImageOps
+
+@dataclass
+class ImagePreprocessConfig:
+    enabled: bool = True
+    max_side: int = 896  # longest side after resizing; match the VLM's input resolution
+    format: str = "JPEG"  # JPEG or WEBP
+    quality: int = 85
+    workers: int = 4
+    cache_entries: int = 256
+    cache_max_bytes: int = 64 * 1024 * 1024  # total size of the cached images
+
+class ImagePreprocessor:
+    """Downscales and re-encodes images before they are base64-embedded in VLM requests.
+
+    Work runs in a thread pool (Pillow releases the GIL while resizing/encoding) and
+    results are cached by content hash, so repeated images are only processed once.
+    """
+    def __init__(self, config: ImagePreprocessConfig):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config.workers, thread_name_prefix="image-preprocess")
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _cache_get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def _cache_put(self, key: str, value: Tuple[bytes, str]):
+        if len(value[0]) > self.config.cache_max_bytes:
+            return
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self._cache_bytes -= len(previous[0])
+            self._cache[key] = value
+            self._cache_bytes += len(value[0])
+            while len(self._cache) > self.config.cache_entries or self._cache_bytes > self.config.cache_max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted[0])
+
+    def _process(self, data: bytes) -> Tuple[bytes, str, bool]:
+        """Re-encoded image, its content type, and whether it had to be downscaled."""
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            resized = max(image.size) > self.config.max_side
+            image.thumbnail((self.config.max_side, self.config.max_side), Image.Resampling.LANCZOS)
+            image_format = self.config.format.upper()
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            out_buf = io.BytesIO()
+            image.save(out_buf, format=image_format, quality=self.config.quality)
+        return out_buf.getvalue(), f"image/{image_format.lower()}", resized
+
+    async def process(self, data: bytes, content_type: str) -> Tuple[bytes, str]:
+        """Return (bytes, content type) ready for embedding; the original if it cannot be improved."""
+        if not self.config.enabled:
+            return data, content_type
+        key = hashlib.sha256(data).hexdigest()
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        try:
+            processed, processed_type, resized = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._process, data)
+        except Exception as e:
+            print(f"Image pre-processing failed, sending original: {e}")
+            return data, content_type
+        if not resized and len(processed) >= len(data):
+            # Fits the resolution and is already small: re-encoding would only cost quality
+            processed, processed_type = data, content_type
+        with self._lock:
+            self.bytes_in += len(data)
+            self.bytes_out += len(processed)
+        self._cache_put(key, (processed, processed_type))
+        return processed, processed_type
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "cache_entries": len(self._cache),
+                "cache_bytes": self._cache_bytes,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import httpx
+from instrumentation import use_trace_id, log_event
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    backend: str
+    description: str = ""
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    webhook_url: Optional[str] = None
+    status_code: Optional[int] = None  # upstream status of the stored result
+    content_type: Optional[str] = None
+    result_size: Optional[int] = None
+    error: Optional[str] = None
+    task_monitor: Optional[Any] = None  # add_task response, if the task monitor accepted the job
+    trace_id: Optional[str] = None  # of the submitting request, so upstream calls join its trace
+
+    def public(self) -> dict:
+        record = asdict(self)
+        if self.status == SUCCEEDED:
+            record["result_url"] = f"/jobs/{self.id}/result"
+        return record
+
+@dataclass
+class JobResult:
+    status_code: int
+    content_type: str
+
+class QueueFullError(Exception):
+    pass
+
+# A runner gets the job's input directory and the path to write the result body to
+JobRunner = Callable[[str, str], Awaitable[JobResult]]
+
+class JobManager:
+    """Runs long requests in the background so clients do not hold a connection open.
+
+    Each backend has its own bounded queue and as many workers as its concurrency
+    limit, so a slow backend cannot starve the others and a full queue turns into an
+    immediate 429 for the submitter instead of a pile of open sockets. Inputs,
+    results and job records live under store_dir; finished jobs expire after result_ttl.
+    """
+    def __init__(self, store_dir: str, backend_limits: Dict[str, int], max_queue: int = 100,
+                 result_ttl: float = 24 * 3600, webhook_timeout: float = 10.0, webhook_retries: int = 3):
+        self.store_dir = store_dir
+        self.backend_limits = backend_limits
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.webhook_timeout = webhook_timeout
+        self.webhook_retries = webhook_retries
+        self.jobs: Dict[str, Job] = {}
+        self._runners: Dict[str, JobRunner] = {}
+        self._kind_backends: Dict[str, str] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._webhook_client: Optional[httpx.AsyncClient] = None
+        self._save_lock = threading.Lock()
+        self.on_submit: Optional[Callable[[Job], Awaitable[Any]]] = None
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.store_dir, job_id)
+
+    def input_dir(self, job_id: str) -> str:
+        return os.path.join(self.job_dir(job_id), "inputs")
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.job_dir(job_id), "result")
+
+    def _save(self, job: Job):
+        path = os.path.join(self.job_dir(job.id), "job.json")
+        with self._save_lock:
+            with open(path + ".tmp", "w") as f:
+                json.dump(asdict(job), f)
+            os.replace(path + ".tmp", path)
+
+    def _load(self):
+        """Reload job records from a previous run; jobs it did not finish are marked failed."""
+        for job_id in os.listdir(self.store_dir):
+            path = os.path.join(self.job_dir(job_id), "job.json")
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path) as f:
+                    job = Job(**json.load(f))
+            except (ValueError, TypeError) as e:
+                print(f"Skipping unreadable job record {path}: {e}")
+                continue
+            if job.status in (QUEUED, RUNNING):
+                job.status, job.error, job.finished_at = FAILED, "Interrupted by a restart", time.time()
+                self._save(job)
+            self.jobs[job.id] = job
+
+    async def start(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        await asyncio.to_thread(self._load)
+        self._webhook_client = httpx.AsyncClient(timeout=self.webhook_timeout)
+        for backend, limit in self.backend_limits.items():
+            self._queues[backend] = asyncio.Queue(maxsize=self.max_queue)
+            for _ in range(max(1, limit)):
+                self._tasks.append(asyncio.create_task(self._worker(backend)))
+        self._tasks.append(asyncio.create_task(self._expire_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+
+    def register(self, kind: str, backend: str, runner: JobRunner):
+        if backend not in self.backend_limits:
+            raise ValueError(f"No concurrency limit configured for backend '{backend}'")
+        self._runners[kind] = runner
+        self._kind_backends[kind] = backend
+
+    def new_job(self, kind: str, description: str = "", webhook_url: Optional[str] = None,
+                trace_id: Optional[str] = None) -> Job:
+        """Create a job and its input directory; fill the inputs, then submit()."""
+        if kind not in self._runners:
+            raise KeyError(kind)
+        job = Job(id=uuid.uuid4().hex, kind=kind, backend=self._kind_backends[kind],
+                  description=description, webhook_url=webhook_url, trace_id=trace_id)
+        os.makedirs(self.input_dir(job.id), exist_ok=True)
+        return job
+
+    async def discard(self, job: Job):
+        self.jobs.pop(job.id, None)
+        await asyncio.to_thread(shutil.rmtree, self.job_dir(job.id), True)
+
+    async def submit(self, job: Job):
+        """Queue a job; raises QueueFullError (and discards the job) when its backend is saturated."""
+        queue = self._queues[job.backend]
+        full = QueueFullError(f"Queue for {job.backend} is full ({self.max_queue} jobs)")
+        if queue.full():
+            await self.discard(job)
+            raise full
+        self.jobs[job.id] = job
+        await asyncio.to_thread(self._save, job)
+        try:
+            queue.put_nowait(job.id)
+        except asyncio.QueueFull:
+            await self.discard(job)
+            raise full
+        if self.on_submit is not None:
+            asyncio.create_task(self._notify_submit(job))
+
+    async def _notify_submit(self, job: Job):
+        try:
+            job.task_monitor = await self.on_submit(job)
+            await asyncio.to_thread(self._save, job)
+        except Exception as e:
+            print(f"Could not register job {job.id} with the task monitor: {e!r}")
+
+    async def _worker(self, backend: str):
+        queue = self._queues[backend]
+        while True:
+            job = self.jobs.get(await queue.get())
+            try:
+                if job is not None:
+                    with use_trace_id(job.trace_id):
+                        await self._run(job)
+            except Exception as e:
+                # A worker that dies is never replaced, so one bad job must not take it down
+                print(f"Worker for {backend} failed on job {job.id if job else '?'}: {e!r}")
+            finally:
+                queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status, job.started_at = RUNNING, time.time()
+        try:
+            await asyncio.to_thread(self._save, job)
+            result = await self._runners[job.kind](self.input_dir(job.id), self.result_path(job.id))
+            job.status_code, job.content_type = result.status_code, result.content_type
+            job.result_size = os.path.getsize(self.result_path(job.id))
+            job.status = SUCCEEDED if result.status_code < 400 else FAILED
+            if job.status == FAILED:
+                job.error = f"Upstream returned {result.status_code}"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Job {job.id} ({job.kind}) failed: {e!r}")
+            job.status, job.error = FAILED, str(e) or repr(e)
+        job.finished_at = time.time()
+        try:
+            log_event("job", job_id=job.id, kind=job.kind, status=job.status, error=job.error,
+                      queued_seconds=job.started_at - job.created_at, run_seconds=job.finished_at - job.started_at)
+            # Inputs are no longer needed once the job has run
+            await asyncio.to_thread(shutil.rmtree, self.input_dir(job.id), True)
+            await asyncio.to_thread(self._save, job)
+        except Exception as e:
+            # e.g. a full disk: the job must still end, or it stays running forever
+            print(f"Could not record the outcome of job {job.id}: {e!r}")
+            job.status, job.error = FAILED, f"Could not record the result: {e!r}"
+        if job.webhook_url:
+            asyncio.create_task(self._send_webhook(job))
+
+    async def _send_webhook(self, job: Job):
+        for attempt in range(self.webhook_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(30.0, 2 ** (attempt - 1)))
+            try:
+                response = await self._webhook_client.post(job.webhook_url, json=job.public())
+                if response.status_code < 500:
+                    return
+                print(f"Webhook for job {job.id} returned {response.status_code}")
+            except httpx.HTTPError as e:
+                print(f"Webhook for job {job.id} failed: {e!r}")
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(min(600.0, max(1.0, self.result_ttl / 4)))
+            cutoff = time.time() - self.result_ttl
+            for job in list(self.jobs.values()):
+                if job.finished_at is not None and job.finished_at < cutoff:
+                    del self.jobs[job.id]
+                    await asyncio.to_thread(shutil.rmtree, self.job_dir(job.id), True)
+
+    def stats(self) -> dict:
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "jobs": counts,
+            "queues": {
+                backend: {"queued": queue.qsize(), "max_queue": self.max_queue, "workers": self.backend_limits[backend]}
+                for backend, queue in self._queues.items()
+            },
+        }
@@ -1,16 +1,26 @@
-from typing import List
+from typing import List, Literal, Optional
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
 from starlette.background import BackgroundTask
 from starlette.types import Send
 import lmstudio as lms
 import httpx
 import os
+import sys
 import openai
+import asyncio
 import base64
-app = FastAPI()
+import json
+import shutil
+from contextlib import asynccontextmanager, ExitStack
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../shared")))
+from instrumentation import instrument_app, stage, log_event, current_trace_id
+from upstreams import UpstreamRegistry
+from image_preprocess import ImagePreprocessor, ImagePreprocessConfig
+from jobs import JobManager, JobResult, QueueFullError
 
 # Data model
 class TaskInfo(BaseModel):
@@ -19,17 +29,83 @@ class TaskInfo(BaseModel):
 class VisualPrompt(BaseModel):
     text: str
     image64: str
+class CaptionPipelineRequest(BaseModel):
+    file_paths: List[str]
+    parameter_name: Literal["description", "evaluation", "additional_info"] = "description"
+    profile: Optional[str] = None
+    window_seconds: Optional[float] = None
 
 #TASK_MONITOR_URL = "http://agstudio.local:6010"  # Example backend
 TASK_MONITOR_URL = os.getenv("TASK_MONITOR_URL", "http://localhost:8002" )
 OPENAI_MIDDLE_URL = os.getenv("OPENAI_MIDDLE_URL", "http://localhost:1234" )
 VLM_MODEL = os.getenv("VLM_MODEL", "gemma-3-27b-it-qat" )
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key")
+VLM_MAX_TOKENS = int(os.getenv("VLM_MAX_TOKENS", "1000"))
+image_preprocessor = ImagePreprocessor(ImagePreprocessConfig(
+    enabled=os.getenv("VQA_IMAGE_PREPROCESS", "1") == "1",
+    max_side=int(os.getenv("VQA_IMAGE_MAX_SIDE", "896")),
+    format=os.getenv("VQA_IMAGE_FORMAT", "JPEG"),
+    quality=int(os.getenv("VQA_IMAGE_QUALITY", "85")),
+    workers=int(os.getenv("VQA_IMAGE_WORKERS", "4")),
+    cache_entries=int(os.getenv("VQA_IMAGE_CACHE_ENTRIES", "256")),
+    cache_max_bytes=int(os.getenv("VQA_IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+))
 MUSIC_HIGHLIGHT_URL=os.getenv("MUSIC_HIGHLIGHT_URL", "http://localhost:8101")
 MUSIC_CAPTION_URL=os.getenv("MUSIC_CAPTION_URL", "http://localhost:8102")
+REPOSITORY_URL = os.getenv("REPOSITORY_URL", "http://localhost:8103")
+STORY_BACKEND_URL = os.getenv("STORY_BACKEND_URL", "http://agstudio.local:7000")  # Example backend
+# Per-upstream pool/timeout/retry overrides, keyed by the names below
+UPSTREAM_CONFIG_JSON = os.getenv("UPSTREAM_CONFIG_JSON", "{}")
+
+upstreams = UpstreamRegistry.from_env({
+    "task_monitor": TASK_MONITOR_URL,
+    "openai_middle": OPENAI_MIDDLE_URL,
+    "music_highlight": MUSIC_HIGHLIGHT_URL,
+    "music_caption": MUSIC_CAPTION_URL,
+    "repository": REPOSITORY_URL,
+    "story": STORY_BACKEND_URL,
+}, UPSTREAM_CONFIG_JSON)
+
+# Background jobs: results are kept under JOB_STORE_DIR; each backend gets its own queue and worker count
+JOB_STORE_DIR = os.getenv("JOB_STORE_DIR", "jobs")
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "100"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(24 * 3600)))
+JOB_BACKEND_LIMITS = json.loads(os.getenv("JOB_BACKEND_LIMITS_JSON",
+                                          '{"music_caption": 1, "music_highlight": 4, "openai_middle": 8}'))
+# Highlight -> caption -> metadata pipeline: tracks in flight per request, and paths per request
+PIPELINE_CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", "4"))
+PIPELINE_MAX_PATHS = int(os.getenv("PIPELINE_MAX_PATHS", "256"))
+job_manager = JobManager(JOB_STORE_DIR, JOB_BACKEND_LIMITS, max_queue=JOB_MAX_QUEUE, result_ttl=JOB_RESULT_TTL_SECONDS)
+
+openai_client = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global openai_client
+    await upstreams.start()
+    # One async client for the app lifetime, sharing the pooled openai_middle connections
+    openai_client = openai.AsyncOpenAI(
+        base_url=OPENAI_MIDDLE_URL,
+        api_key=OPENAI_API_KEY,
+        http_client=upstreams.client("openai_middle"),
+    )
+    await job_manager.start()
+    yield
+    await job_manager.stop()
+    await upstreams.close()
+    image_preprocessor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app, "task-manager")
+
+def send_activity_log(activity: str, prompt: str, files: List[UploadFile]):
+    """Record a user-facing activity in the structured log (non-blocking)."""
+    log_event("activity", activity=activity, prompt=prompt,
+              files=[{"name": f.filename, "content_type": f.content_type, "size": f.size} for f in files])
+
 async def add_task(task_info: TaskInfo):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{TASK_MONITOR_URL}/api/task", json=task_info.model_dump())
-        return response.json()
+    response = await upstreams.request("task_monitor", "POST", "/api/task", json=task_info.model_dump())
+    return response.json()
 
 async def submit_task(request: Request):
     data = await request.json()
@@ -39,40 +115,35 @@ async def submit_task(request: Request):
         return JSONResponse(status_code=400, content={"error": "Missing data"})
 
     # Forward to Next.js
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"{TASK_MONITOR_URL}/api/task",
-            json={"name": data["name"], "description": data["description"]},
-            cookies={"sid": cookies.get("sid")},  # forward the session cookie
-        )
+    sid = cookies.get("sid")
+    res = await upstreams.request(
+        "task_monitor", "POST", "/api/task",
+        json={"name": data["name"], "description": data["description"]},
+        headers={"Cookie": f"sid={sid}"} if sid else {},  # forward the session cookie
+    )
 
     return JSONResponse(status_code=res.status_code, content=res.json())
 
 @app.post("/init-session")
 async def init_session():
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        monitor_response = await client.get(f"{TASK_MONITOR_URL}/init-session")
-        # Extract session cookie
-        set_cookie = monitor_response.headers.get("Set-Cookie")
-        if not set_cookie:
-            raise HTTPException(status_code=500, detail="Session cookie not received from task monitor.")
-
-        # Return the session cookie to client
-        return JSONResponse(content="Session initialized", headers={"Set-Cookie": set_cookie})
+    monitor_response = await upstreams.request("task_monitor", "GET", "/init-session", follow_redirects=True)
+    # Extract session cookie
+    set_cookie = monitor_response.headers.get("Set-Cookie")
+    if not set_cookie:
+        raise HTTPException(status_code=500, detail="Session cookie not received from task monitor.")
+
+    # Return the session cookie to client
+    return JSONResponse(content="Session initialized", headers={"Set-Cookie": set_cookie})
 @app.post("/basic-story-format")
 async def basic_story_format(request: Request):
     data = await request.json()
-    EXTERNAL_BACKEND_URL = "http://agstudio.local:7000/basic-format"  # Example backend
-    async with httpx.AsyncClient() as client:
-        response = await client.post(EXTERNAL_BACKEND_URL, json=data.dict())
-        return response.json()
+    response = await upstreams.request("story", "POST", "/basic-format", json=data)
+    return response.json()
 @app.post("/story-add-emotion")
 async def story_add_emotion(request: Request):
     data = await request.json()
-    EXTERNAL_BACKEND_URL = "http://agstudio.local:7000/add-character-emotion"  # Example backend
-    async with httpx.AsyncClient() as client:
-        response = await client.post(EXTERNAL_BACKEND_URL, json=data.model_dump())
-        return response.json()
+    response = await upstreams.request("story", "POST", "/add-character-emotion", json=data)
+    return response.json()
 
 @app.post("/multimodal-input")
 async def multimodal_input(
@@ -94,49 +165,113 @@ async def multimodal_input(
         )
 
 
-@app.post("/music-caption")
-async def music_caption(
-    prompt: str = Form(...),
-    audios: List[UploadFile] = File([]),
-):
-    return await inner_general_post(prompt, [], audios, MUSIC_CAPTION_URL + "/music-caption")
-@app.post("/music-highlight")
-async def music_highlight(
-    audios: List[UploadFile] = File([]),
-):
-    return await inner_general_post("", [], audios, MUSIC_HIGHLIGHT_URL + "/music-highlight")
+# The music endpoints relay the client's multipart body untouched, so their form fields
+# (prompt, audios) are only documented here and validated by the upstream service.
+MULTIPART_AUDIO_BODY = {"requestBody": {"content": {"multipart/form-data": {"schema": {
+    "type": "object",
+    "properties": {
+        "prompt": {"type": "string"},
+        "audios": {"type": "array", "items": {"type": "string", "format": "binary"}},
+    },
+}}}}}
+
+@app.post("/music-caption", openapi_extra=MULTIPART_AUDIO_BODY)
+async def music_caption(request: Request):
+    return await relay_request_body(request, "music_caption", "/music-caption")
+@app.post("/music-highlight", openapi_extra=MULTIPART_AUDIO_BODY)
+async def music_highlight(request: Request):
+    return await relay_request_body(request, "music_highlight", "/music-highlight")
+
+class PipelineStepError(Exception):
+    def __init__(self, step: str, response: httpx.Response):
+        super().__init__(f"{step} failed with HTTP {response.status_code}: {response.text[:500]}")
+        self.step = step
+        self.status_code = response.status_code
+
+async def caption_repository_file(file_path: str, request: CaptionPipelineRequest) -> dict:
+    """Highlight, caption and annotate one stored track.
+
+    music-analysis fetches the track from the repository itself; only the highlight WAV
+    (already at the caption model's 48 kHz) comes back here, and it is handed to
+    music-caption from memory.
+    """
+    highlight_params = {"file_path": file_path}
+    if request.window_seconds:
+        highlight_params["window_seconds"] = request.window_seconds
+    response = await upstreams.request("music_highlight", "POST", "/music-highlight", params=highlight_params)
+    if response.status_code != 200:
+        raise PipelineStepError("highlight", response)
+    highlight_start = float(response.headers.get("X-Highlight-Start", "0"))
+    name = f"{os.path.splitext(os.path.basename(file_path))[0]}.highlight.wav"
+    response = await upstreams.request(
+        "music_caption", "POST", "/music-caption",
+        params={"profile": request.profile} if request.profile else None,
+        data={"prompt": "caption"},
+        files={"audios": (name, response.content, "audio/wav")},
+    )
+    if response.status_code != 200:
+        raise PipelineStepError("caption", response)
+    caption = response.json()
+    response = await upstreams.request("repository", "PUT", "/files/metadata", json={
+        "file_path": file_path, "parameter_name": request.parameter_name, "value": caption,
+    })
+    if response.status_code != 200:
+        raise PipelineStepError("store", response)
+    return {"file_path": file_path, "caption": caption, "highlight_start_seconds": highlight_start}
+
+@app.post("/pipelines/highlight-caption")
+async def highlight_caption_pipeline(request: CaptionPipelineRequest):
+    """Caption stored tracks from their highlight and write the caption into their metadata.
+
+    Up to PIPELINE_CONCURRENCY paths are processed at once. A failing path does not stop the
+    others; its entry carries the failed step and error instead of a caption.
+    """
+    if not request.file_paths:
+        raise HTTPException(status_code=400, detail="No file_paths given")
+    if len(request.file_paths) > PIPELINE_MAX_PATHS:
+        raise HTTPException(status_code=400, detail=f"At most {PIPELINE_MAX_PATHS} file_paths per request")
+    semaphore = asyncio.Semaphore(PIPELINE_CONCURRENCY)
+
+    async def run(file_path: str) -> dict:
+        async with semaphore:
+            try:
+                with stage("pipeline_track", target="highlight-caption"):
+                    result = await caption_repository_file(file_path, request)
+            except PipelineStepError as e:
+                result = {"file_path": file_path, "step": e.step, "status_code": e.status_code, "error": str(e)}
+            except httpx.HTTPError as e:
+                result = {"file_path": file_path, "error": repr(e)}
+        log_event("pipeline_track", pipeline="highlight-caption", file_path=file_path, error=result.get("error"))
+        return result
+
+    results = await asyncio.gather(*[run(file_path) for file_path in request.file_paths])
+    return {
+        "results": results,
+        "succeeded": sum(1 for result in results if "error" not in result),
+        "failed": sum(1 for result in results if "error" in result),
+    }
+
 @app.post("/vqa", response_class=PlainTextResponse)
 async def vqa(
     prompt: str = Form(...),  # Text field
-    images: List[UploadFile] = File(...)  # Image file
+    images: List[UploadFile] = File(...),  # Image file
+    stream: bool = Form(False)  # Send tokens as server-sent events while they are generated
 ):
     print(f"Received VQA request with prompt: {prompt} and images: {len(images)}")
     send_activity_log("Visual Question Answering", prompt, images)
-    return await inner_openai(prompt, images, [], OPENAI_MIDDLE_URL, VLM_MODEL)
+    return await inner_openai(prompt, images, [], VLM_MODEL, stream=stream)
 async def inner_openai(
     prompt: str,
     images: List[UploadFile],
     audios: List[UploadFile],
-    url: str,  # Default to the OpenAI middle URL
-    model: str  # Default to the VLM model,
+    model: str,  # Default to the VLM model,
+    stream: bool = False
 ):
-    openai_client = openai.OpenAI(
-        base_url=url,  # Adjust if using a different endpoint
-        api_key="your-openai-api-key",  # Replace with your actual API key
-        # Or use environment variable: api_key=os.getenv("OPENAI_API_KEY")
-    )
     # Read and encode the images
     base64_images = []
     print(f"Processing images: {len(images)}")
     for img in images:
-        image_data = await img.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        base64_images.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:{img.content_type};base64,{base64_image}"
-            }
-        })
+        base64_images.append(await image_content_part(await img.read(), img.content_type))
 
     # Read and encode the audios
     base64_audios = []
@@ -150,23 +285,21 @@ async def inner_openai(
                 "url": f"data:{audio.content_type};base64,{base64_audio}"
             }
         })
+    messages = vqa_messages(prompt, base64_images)
 
     try:
         print(f"Creating chat completion with model: {model}")
         # Create the chat completion with vision
-        response = openai_client.chat.completions.create(
-            model=model,  # Use gpt-4o or gpt-4-vision-preview for vision capabilities
-            messages = [
-                {"role": "user", "content": [
-
-                    {"type": "text", "text": prompt},
-                    *base64_images
-                    #,*base64_audios
-                ]
-                }
-            ],
-            max_tokens=1000  # Adjust as needed
-        )
+        with stage("inference", target="vlm"):
+            response = await openai_client.chat.completions.create(
+                model=model,  # Use gpt-4o or gpt-4-vision-preview for vision capabilities
+                messages=messages,
+                max_tokens=VLM_MAX_TOKENS,
+                stream=stream
+            )
+        if stream:
+            return StreamingResponse(openai_event_stream(response), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache"})
         answer = response.choices[0].message.content
         print(f"VQA Answer: {answer}")
         return answer
@@ -177,57 +310,201 @@ async def inner_openai(
             content={"error": f"Failed to process request: {str(e)}"}, 
             status_code=500
         )
-async def inner_general_post(
-    prompt: str,
-    images: List[UploadFile],
-    audios: List[UploadFile],
-    url:  str
-):
-    print(f"Processing request to {url} with prompt: {prompt}")
-    # Step 1: Analyze the inputs
-    if should_relay(prompt, images, audios):
-        # Step 2: Rebuild multipart form
-        files = []
-
-        # Attach images
-        for img in images:
-            content = await img.read()
-            files.append(("images", (img.filename, content, img.content_type)))
-
-        # Attach audios
-        for audio in audios:
-            content = await audio.read()
-            files.append(("audios", (audio.filename, content, audio.content_type)))
-        # Attach prompt as form field
-        data = {'prompt': prompt}
-        print(f"Sending files")
-        # Step 3: Send to target
-        async with httpx.AsyncClient() as client:
-            proxy_response = await client.post(url, data=data, files=files, timeout=120.0)
-        response_headers = [
-            (name, value)
-            for name, value in proxy_response.headers.items()
-            if name.lower() not in ["content-encoding", "transfer-encoding", "connection", "content-length"]
+
+async def image_content_part(image_data: bytes, content_type: str) -> dict:
+    # Downscale/re-encode to the model's resolution before embedding
+    with stage("image_preprocess"):
+        image_data, content_type = await image_preprocessor.process(image_data, content_type)
+    with stage("base64_encode"):
+        base64_image = base64.b64encode(image_data).decode('utf-8')
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{content_type};base64,{base64_image}"
+        }
+    }
+
+def vqa_messages(prompt: str, image_parts: List[dict]) -> List[dict]:
+    return [
+        {"role": "user", "content": [
+
+            {"type": "text", "text": prompt},
+            *image_parts
+            #,*base64_audios
         ]
+        }
+    ]
 
-        async def general_response_iterator():
-            # This unified iterator streams bytes regardless of content type
-            async for chunk in proxy_response.aiter_bytes():
-                yield chunk
-
-        # Create a single StreamingResponse for all types of responses
-        response = StreamingResponse(
-            general_response_iterator(),
-            status_code=proxy_response.status_code,
-            media_type=proxy_response.headers.get("content-type"),
-            headers=dict(response_headers), # Convert list of tuples to dictionary for headers
-            background=BackgroundTask(proxy_response.aclose) # Ensure the upstream connection is closed
-        )
-        return response
-    # Step 5: Handle locally if not relayed
-    return JSONResponse(
-        content={"error": "Inputs do not meet relay criteria."},
-        status_code=400
+@app.get("/vqa/preprocess-stats")
+async def vqa_preprocess_stats():
+    return image_preprocessor.stats()
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+async def openai_event_stream(response):
+    """Relay a streamed chat completion as server-sent events: {"delta": ...} per chunk, then [DONE]."""
+    try:
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield sse_event({"delta": delta})
+        yield "data: [DONE]\n\n"
+    except Exception as e:
+        print(f"Error while streaming VQA answer: {str(e)}")
+        yield sse_event({"error": f"Failed to process request: {str(e)}"}, event="error")
+    finally:
+        await response.close()
+
+def proxy_streaming_response(proxy_response: httpx.Response) -> StreamingResponse:
+    response_headers = [
+        (name, value)
+        for name, value in proxy_response.headers.items()
+        if name.lower() not in ["content-encoding", "transfer-encoding", "connection", "content-length"]
+    ]
+
+    async def general_response_iterator():
+        # This unified iterator streams bytes regardless of content type
+        async for chunk in proxy_response.aiter_bytes():
+            yield chunk
+
+    # Create a single StreamingResponse for all types of responses
+    return StreamingResponse(
+        general_response_iterator(),
+        status_code=proxy_response.status_code,
+        media_type=proxy_response.headers.get("content-type"),
+        headers=dict(response_headers), # Convert list of tuples to dictionary for headers
+        background=BackgroundTask(proxy_response.aclose) # Ensure the upstream connection is closed
+    )
+
+async def relay_request_body(request: Request, upstream: str, path: str):
+    """Pipe the incoming body to the upstream chunk by chunk and stream the answer back."""
+    content_type = request.headers.get("content-type")
+    if not content_type:
+        return JSONResponse(content={"error": "Missing Content-Type"}, status_code=400)
+    headers = {"content-type": content_type}
+    if "content-length" in request.headers:
+        headers["content-length"] = request.headers["content-length"]
+    print(f"Relaying request body to {upstream}{path}")
+    proxy_response = await upstreams.stream(
+        upstream, "POST", path,
+        params=request.query_params,
+        content=request.stream(),
+        headers=headers,
     )
-def should_relay(prompt: str, images: List[UploadFile], audios: List[UploadFile]) -> bool:
-    return True
\ No newline at end of file
+    return proxy_streaming_response(proxy_response)
+
+# Job inputs are spooled to <job>/inputs: form.json plus one file per upload
+def spool_job_inputs(input_dir: str, prompt: str, params: dict, uploads: List[tuple]):
+    files = []
+    for i, (field, upload) in enumerate(uploads):
+        name = f"{i:04d}"
+        upload.file.seek(0)
+        with open(os.path.join(input_dir, name), "wb") as f:
+            shutil.copyfileobj(upload.file, f, 1024 * 1024)
+        files.append({"field": field, "filename": upload.filename, "content_type": upload.content_type, "path": name})
+    with open(os.path.join(input_dir, "form.json"), "w") as f:
+        json.dump({"prompt": prompt, "params": params, "files": files}, f)
+
+def load_job_inputs(input_dir: str) -> dict:
+    with open(os.path.join(input_dir, "form.json")) as f:
+        return json.load(f)
+
+def relay_job_runner(upstream: str, path: str):
+    """Job runner that re-posts the spooled form to an upstream and stores its response body."""
+    async def run(input_dir: str, result_path: str) -> JobResult:
+        form = load_job_inputs(input_dir)
+        with ExitStack() as stack:
+            files = [
+                (f["field"], (f["filename"], stack.enter_context(open(os.path.join(input_dir, f["path"]), "rb")), f["content_type"]))
+                for f in form["files"]
+            ]
+            proxy_response = await upstreams.stream(upstream, "POST", path, params=form["params"],
+                                                    data={"prompt": form["prompt"]}, files=files)
+            try:
+                with open(result_path, "wb") as out:
+                    async for chunk in proxy_response.aiter_bytes():
+                        out.write(chunk)
+            finally:
+                await proxy_response.aclose()
+        return JobResult(proxy_response.status_code, proxy_response.headers.get("content-type", "application/octet-stream"))
+    return run
+
+async def run_vqa_job(input_dir: str, result_path: str) -> JobResult:
+    form = load_job_inputs(input_dir)
+    image_parts = []
+    for f in form["files"]:
+        with open(os.path.join(input_dir, f["path"]), "rb") as image_file:
+            image_parts.append(await image_content_part(image_file.read(), f["content_type"]))
+    with stage("inference", target="vlm"):
+        response = await openai_client.chat.completions.create(
+            model=VLM_MODEL,
+            messages=vqa_messages(form["prompt"], image_parts),
+            max_tokens=VLM_MAX_TOKENS,
+        )
+    with open(result_path, "w") as out:
+        out.write(response.choices[0].message.content or "")
+    return JobResult(200, "text/plain; charset=utf-8")
+
+job_manager.register("music-caption", "music_caption", relay_job_runner("music_caption", "/music-caption"))
+job_manager.register("music-highlight", "music_highlight", relay_job_runner("music_highlight", "/music-highlight"))
+job_manager.register("vqa", "openai_middle", run_vqa_job)
+
+async def register_job_task(job) -> dict:
+    # Queued jobs show up in the task monitor like any other task
+    return await add_task(TaskInfo(name=f"{job.kind} job {job.id}", description=job.description or job.kind))
+job_manager.on_submit = register_job_task
+
+@app.get("/jobs/stats")
+async def job_stats():
+    return job_manager.stats()
+
+@app.post("/jobs/{kind}", status_code=202)
+async def submit_job(
+    kind: str,
+    request: Request,
+    prompt: str = Form(""),
+    images: List[UploadFile] = File([]),
+    audios: List[UploadFile] = File([]),
+    webhook_url: Optional[str] = Form(None),
+):
+    """Queue a music-caption, music-highlight or vqa request and return its job id at once.
+
+    Query parameters are passed on to the upstream endpoint. Poll GET /jobs/{id}, or give
+    webhook_url to have the finished job record POSTed to it.
+    """
+    try:
+        job = job_manager.new_job(kind, description=prompt, webhook_url=webhook_url, trace_id=current_trace_id())
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown job kind: {kind}")
+    uploads = [("images", img) for img in images] + [("audios", audio) for audio in audios]
+    try:
+        await asyncio.to_thread(spool_job_inputs, job_manager.input_dir(job.id), prompt,
+                                dict(request.query_params), uploads)
+        await job_manager.submit(job)
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+    except BaseException:
+        await job_manager.discard(job)
+        raise
+    return JSONResponse(status_code=202, content=job.public(), headers={"Location": f"/jobs/{job.id}"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.public()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    result_path = job_manager.result_path(job_id)
+    if job.status_code is None or not os.path.isfile(result_path):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}, no result available")
+    return FileResponse(result_path, status_code=job.status_code, media_type=job.content_type)
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, fields
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict
+import httpx
+from instrumentation import trace_headers, observe_stage
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {502, 503, 504}
+
+@dataclass
+class UpstreamConfig:
+    base_url: str
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 120.0
+    write_timeout: float = 120.0
+    pool_timeout: float = 10.0
+    http2: bool = False
+    retries: int = 2
+    backoff: float = 0.2
+    backoff_max: float = 5.0
+
+    def update(self, overrides: dict):
+        known = {f.name for f in fields(self)}
+        for key, value in overrides.items():
+            if key not in known:
+                raise ValueError(f"Unknown upstream option: {key}")
+            setattr(self, key, value)
+
+async def _add_trace_headers(request: httpx.Request):
+    # Every upstream call carries the trace ID of the request that caused it
+    for name, value in trace_headers().items():
+        request.headers.setdefault(name, value)
+
+def _no_cookie_jar() -> CookieJar:
+    # The clients are shared by every caller: never remember a session cookie from one for another
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+class UpstreamRegistry:
+    """App-lifetime httpx clients, one connection pool per upstream service."""
+    def __init__(self, configs: Dict[str, UpstreamConfig]):
+        self.configs = configs
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+
+    @classmethod
+    def from_env(cls, base_urls: Dict[str, str], config_json: str):
+        """Per-upstream overrides come from JSON, e.g. {"music_caption": {"read_timeout": 300, "retries": 0}}."""
+        overrides = json.loads(config_json) if config_json else {}
+        configs = {}
+        for name, base_url in base_urls.items():
+            config = UpstreamConfig(base_url=base_url)
+            config.update(overrides.get(name, {}))
+            configs[name] = config
+        return cls(configs)
+
+    async def start(self):
+        for name, config in self.configs.items():
+            self.clients[name] = httpx.AsyncClient(
+                base_url=config.base_url,
+                http2=config.http2,
+                cookies=_no_cookie_jar(),
+                event_hooks={"request": [_add_trace_headers]},
+                limits=httpx.Limits(
+                    max_connections=config.max_connections,
+                    max_keepalive_connections=config.max_keepalive_connections,
+                    keepalive_expiry=config.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(
+                    connect=config.connect_timeout,
+                    read=config.read_timeout,
+                    write=config.write_timeout,
+                    pool=config.pool_timeout,
+                ),
+            )
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        if name not in self.clients:
+            raise RuntimeError(f"Upstream client '{name}' is not running")
+        return self.clients[name]
+
+    def _delay(self, config: UpstreamConfig, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(config.backoff_max, config.backoff * (2 ** attempt)))
+
+    async def request(self, name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a buffered request, retrying connection failures (and 502/503/504 for idempotent methods)."""
+        client = self.client(name)
+        config = self.configs[name]
+        method = method.upper()
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            try:
+                response = await client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # The request never reached the upstream, so even a POST is safe to resend
+                if attempt >= config.retries:
+                    raise
+                print(f"Upstream {name} unavailable ({e!r}), retry {attempt + 1}/{config.retries}")
+            else:
+                if (response.status_code not in RETRY_STATUSES or method not in IDEMPOTENT_METHODS
+                        or attempt >= config.retries):
+                    observe_stage("upstream_proxy", time.perf_counter() - started, target=name)
+                    return response
+                print(f"Upstream {name} returned {response.status_code}, retry {attempt + 1}/{config.retries}")
+                await response.aclose()
+            await asyncio.sleep(self._delay(config, attempt))
+            attempt += 1
+
+    async def stream(self, name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request and return as soon as the response headers arrive.
+
+        The body may be a one-shot async iterator, so only failures to connect (before any
+        of it was consumed) are retried. The caller must aclose() the response.
+        """
+        client = self.client(name)
+        config = self.configs[name]
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            request = client.build_request(method, url, **kwargs)
+            try:
+                response = await client.send(request, stream=True)
+                # Time to the response headers; the body is relayed afterwards
+                observe_stage("upstream_proxy", time.perf_counter() - started, target=name)
+                return response
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                if attempt >= config.retries:
+                    raise
+                print(f"Upstream {name} unavailable ({e!r}), retry {attempt + 1}/{config.retries}")
+            await asyncio.sleep(self._delay(config, attempt))
+            attempt += 1